@@ -0,0 +1,633 @@
+"""Benchmark the component diagram generator against synthetic projects."""
+
+import argparse
+import array
+import concurrent.futures
+import contextlib
+import io
+import json
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import components
+
+
+def main() -> None:
+    arguments = _parse_command_line()
+    if not arguments.uses_files:
+        arguments.benchmark(arguments, None)
+        return
+    if arguments.corpus:
+        arguments.benchmark(arguments, os.path.abspath(arguments.corpus) + "/")
+        return
+    with tempfile.TemporaryDirectory() as project:
+        _generate_project(
+            project,
+            arguments.modules,
+            arguments.packages,
+            arguments.package_depth,
+            arguments.imports_per_module,
+            arguments.file_size,
+        )
+        arguments.benchmark(arguments, project + "/")
+
+
+def _parse_command_line() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the component diagram generator.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--modules",
+        type=int,
+        default=5000,
+        help="The number of modules in the synthetic project.",
+    )
+    parser.add_argument(
+        "--packages",
+        type=int,
+        default=50,
+        help="The number of packages in the synthetic project.",
+    )
+    parser.add_argument(
+        "--package-depth",
+        type=int,
+        default=1,
+        help="The number of package levels above each module in the synthetic project.",
+    )
+    parser.add_argument(
+        "--imports-per-module",
+        type=int,
+        default=5,
+        help="The number of project modules that each synthetic module imports.",
+    )
+    parser.add_argument(
+        "--file-size",
+        type=int,
+        default=1000,
+        help="The approximate size of each synthetic module, in bytes.",
+    )
+    parser.add_argument(
+        "--corpus",
+        help="Benchmark this existing project instead of generating a synthetic one.",
+    )
+    parser.set_defaults(uses_files=True)
+    subparsers = parser.add_subparsers(required=True)
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="Time every stage from finding the files to writing each format, and print the "
+        "results as JSON for comparison between commits.",
+    )
+    pipeline_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Run the pipeline this many times, and report the fastest time of each stage.",
+    )
+    pipeline_parser.add_argument(
+        "--jobs", type=int, default=1, help="The number of worker processes."
+    )
+    pipeline_parser.add_argument(
+        "--extractor",
+        choices=sorted(components._EXTRACTORS),
+        default="ast",
+        help="The import extractor to time.",
+    )
+    pipeline_parser.add_argument(
+        "--output", help="Write the JSON to this file instead of standard output."
+    )
+    pipeline_parser.set_defaults(benchmark=_benchmark_pipeline)
+    jobs_parser = subparsers.add_parser(
+        "jobs", help="Time import extraction with different numbers of workers."
+    )
+    jobs_parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="The worker counts to time.",
+    )
+    jobs_parser.set_defaults(benchmark=_benchmark_jobs)
+    extractors_parser = subparsers.add_parser(
+        "extractors", help="Time each import extractor over every file."
+    )
+    extractors_parser.set_defaults(benchmark=_benchmark_extractors)
+    resolve_parser = subparsers.add_parser(
+        "resolve",
+        help="Count the stat calls made to resolve sibling imports, with and without the "
+        "directory index.",
+    )
+    resolve_parser.set_defaults(benchmark=_benchmark_resolve)
+    memory_parser = subparsers.add_parser(
+        "memory",
+        help="Measure the memory used by the module table, without writing any files.",
+    )
+    memory_parser.add_argument(
+        "--table-size",
+        type=int,
+        default=100000,
+        help="The number of modules in the table.",
+    )
+    memory_parser.set_defaults(benchmark=_benchmark_memory, uses_files=False)
+    graph_parser = subparsers.add_parser(
+        "graph",
+        help="Time the graph algorithms on a synthetic graph, without writing any files.",
+    )
+    graph_parser.add_argument(
+        "--nodes", type=int, default=100000, help="The number of nodes in the graph."
+    )
+    graph_parser.add_argument(
+        "--edges-per-node",
+        type=int,
+        default=5,
+        help="The number of dependencies of each node.",
+    )
+    graph_parser.set_defaults(benchmark=_benchmark_graph, uses_files=False)
+    write_parser = subparsers.add_parser(
+        "write",
+        help="Measure the throughput of the diagram writers on a synthetic graph, with and "
+        "without chunked writes, without writing any files.",
+    )
+    write_parser.add_argument(
+        "--nodes", type=int, default=20000, help="The number of nodes in the graph."
+    )
+    write_parser.add_argument(
+        "--edges-per-node",
+        type=int,
+        default=5,
+        help="The number of dependencies of each node.",
+    )
+    write_parser.set_defaults(benchmark=_benchmark_write, uses_files=False)
+    frames_parser = subparsers.add_parser(
+        "frames",
+        help="Compare the PlantUML output for a deep package hierarchy with one frame chain "
+        "per module and with each frame written once, and time PlantUML on both if it is "
+        "installed.",
+    )
+    frames_parser.add_argument(
+        "--depth", type=int, default=5, help="The depth of the package hierarchy."
+    )
+    frames_parser.add_argument(
+        "--branching",
+        type=int,
+        default=3,
+        help="The number of subpackages in each package.",
+    )
+    frames_parser.add_argument(
+        "--modules-per-package",
+        type=int,
+        default=5,
+        help="The number of modules in each package.",
+    )
+    frames_parser.add_argument(
+        "--image-type", default="svg", help="The type of image to render."
+    )
+    frames_parser.set_defaults(benchmark=_benchmark_frames, uses_files=False)
+    render_parser = subparsers.add_parser(
+        "render",
+        help="Time writing and rendering the diagram with each format whose program is "
+        "installed.",
+    )
+    render_parser.add_argument(
+        "--image-type", default="svg", help="The type of image to render."
+    )
+    render_parser.set_defaults(benchmark=_benchmark_render)
+    return parser.parse_args()
+
+
+def _generate_project(
+    root: str,
+    module_count: int,
+    package_count: int,
+    package_depth: int = 1,
+    imports_per_module: int = 5,
+    file_size: int = 1000,
+) -> None:
+    """
+    Write a synthetic Python project.
+
+    Args:
+        root (str): The directory in which to write the project.
+        module_count (int): The number of modules to write.
+        package_count (int): The number of packages to spread the modules across.
+        package_depth (int): The number of package levels above each module. The levels
+            above the innermost package branch out more at each level.
+        imports_per_module (int): The number of project modules that each module imports.
+        file_size (int): The approximate size of each module, in bytes. The modules are
+            padded with functions to reach it.
+    """
+    generator = random.Random(0)
+    packages = [
+        ".".join(
+            [
+                f"level_{level}_{package % (level + 1)}"
+                for level in range(1, package_depth)
+            ]
+            + [f"package_{package}"]
+        )
+        for package in range(package_count)
+    ]
+    names = [f"{packages[i % package_count]}.module_{i}" for i in range(module_count)]
+    for package in packages:
+        os.makedirs(os.path.join(root, package.replace(".", "/")), exist_ok=True)
+    function = "\n\ndef function():\n    return os.getcwd()\n"
+    for name in names:
+        imports = generator.sample(names, min(imports_per_module, len(names)))
+        header = '"""A synthetic module."""\n\nimport os\n' + "".join(
+            f"import {i}\n" for i in imports
+        )
+        with open(os.path.join(root, name.replace(".", "/") + ".py"), "w") as f:
+            f.write(header)
+            f.write(function * max(0, (file_size - len(header)) // len(function)))
+
+
+def _get_modules(project: str) -> list:
+    return [
+        components._Module(components._path_to_module_name(f.path, project), f.path)
+        for f in components._get_python_files(project)
+    ]
+
+
+def _benchmark_pipeline(arguments: argparse.Namespace, project: str) -> None:
+    stages = {}
+
+    def stage(name: str, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        stages[name] = min(stages.get(name, elapsed), elapsed)
+        return result
+
+    executor = None
+    if arguments.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(arguments.jobs)
+    try:
+        for _ in range(arguments.repeat):
+            components._PACKAGES.clear()
+            files = stage("find files", components._get_python_files, project)
+            paths = [f.path for f in files]
+            registry = stage(
+                "module table",
+                lambda: components._ModuleRegistry(
+                    components._Module(
+                        components._path_to_module_name(path, project), path
+                    )
+                    for path in paths
+                ),
+            )
+            records = stage(
+                "extract imports",
+                components._extract_all_imports,
+                paths,
+                arguments.jobs,
+                None,
+                arguments.extractor,
+                files,
+                executor,
+            )
+            stage("resolve imports", _resolve_imports, registry, paths, records)
+            graph = stage(
+                "build graph",
+                lambda: components._DependencyGraph.from_modules(
+                    [m for m in registry if components._include_module(m)], registry
+                ),
+            )
+            cycles = stage("find cycles", components._find_cycles, graph)
+            stage("transitive reduction", components._transitive_reduction, graph)
+            stage("collapse packages", components._collapse, graph, 1)
+            stage("shard by package", components._shard_by_package, graph, cycles)
+            for output_format, writer in sorted(components._WRITERS.items()):
+                stage(f"write {output_format}", writer, graph, io.StringIO(), cycles)
+    finally:
+        if executor:
+            executor.shutdown()
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            "corpus": arguments.corpus,
+            "modules": arguments.modules,
+            "packages": arguments.packages,
+            "package_depth": arguments.package_depth,
+            "imports_per_module": arguments.imports_per_module,
+            "file_size": arguments.file_size,
+            "repeat": arguments.repeat,
+            "jobs": arguments.jobs,
+            "extractor": arguments.extractor,
+        },
+        "files": len(files),
+        "edges": graph.edge_count,
+        "stages": stages,
+        "total": sum(stages.values()),
+    }
+    text = json.dumps(results, indent=2) + "\n"
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(text)
+    else:
+        print(text, end="")
+
+
+def _resolve_imports(
+    registry: components._ModuleRegistry, paths: list, records: list
+) -> None:
+    index = components._build_directory_index(paths)
+    imports = dict(zip(paths, records))
+    for module in registry:
+        lines = []
+        names = components._get_imports(module, imports[module.path], index, lines)
+        module.dependencies, module.lines = components._filter_imports(
+            names, registry, lines
+        )
+
+
+def _git_commit():
+    """Get the commit of the benchmarked code, or ``None`` if it is not in Git."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(components.__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _benchmark_jobs(arguments: argparse.Namespace, project: str) -> None:
+    paths = [f.path for f in components._get_python_files(project)]
+    baseline = None
+    for workers in arguments.workers:
+        start = time.perf_counter()
+        components._extract_all_imports(paths, workers)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(
+            f"{workers:>3} workers: {elapsed:8.3f} s  speedup {baseline / elapsed:5.2f}x"
+        )
+
+
+def _benchmark_extractors(arguments: argparse.Namespace, project: str) -> None:
+    paths = [f.path for f in components._get_python_files(project)]
+    for name, extractor in sorted(components._EXTRACTORS.items()):
+        start = time.perf_counter()
+        imports = sum(len(extractor(path)) for path in paths)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>13}: {elapsed:8.3f} s  {len(paths) / elapsed:10.0f} files/s  "
+            f"{imports} imports"
+        )
+
+
+def _benchmark_resolve(arguments: argparse.Namespace, project: str) -> None:
+    modules = _get_modules(project)
+    python_files = [m.path for m in modules]
+    records = [components._extract_imports_with_ast(m.path) for m in modules]
+    for label, make_index in (
+        ("file system", lambda: None),
+        ("directory index", lambda: components._build_directory_index(python_files)),
+    ):
+        with _count_stat_calls() as counter:
+            start = time.perf_counter()
+            index = make_index()
+            for module, imports in zip(modules, records):
+                components._get_imports(module, imports, index)
+            elapsed = time.perf_counter() - start
+        print(f"{label:>15}: {elapsed:8.3f} s  {counter[0]:8} stat calls")
+
+
+def _benchmark_memory(arguments: argparse.Namespace, project: str) -> None:
+    generator = random.Random(0)
+    names = [
+        f"package_{i % 50}.subpackage_{i % 7}.module_{i}"
+        for i in range(arguments.table_size)
+    ]
+    dependencies = [generator.sample(range(len(names)), 5) for _ in names]
+
+    def build_dictionary_modules():
+        modules = [
+            _DictionaryModule(name, "/project/" + name.replace(".", "/") + ".py")
+            for name in names
+        ]
+        for module, imports in zip(modules, dependencies):
+            # Each resolved import used to be a new string.
+            module.dependencies = [names[i][:1] + names[i][1:] for i in imports]
+        return modules
+
+    def build_slotted_modules():
+        modules = [
+            components._Module(name, "/project/" + name.replace(".", "/") + ".py")
+            for name in names
+        ]
+        for module, imports in zip(modules, dependencies):
+            module.dependencies = array.array("i", imports)
+        return modules
+
+    def build_registry():
+        return components._ModuleRegistry(build_slotted_modules())
+
+    for label, build in (
+        ("dictionary modules", build_dictionary_modules),
+        ("slotted modules", build_slotted_modules),
+        ("slotted + registry", build_registry),
+    ):
+        # Copy the names, so that the interned strings are measured too.
+        names[:] = [name.encode().decode() for name in names]
+        components._PACKAGES.clear()
+        tracemalloc.start()
+        modules = build()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del modules
+        print(
+            f"{label:>18}: {current / 2**20:8.1f} MiB  (peak {peak / 2**20:.1f} MiB)  "
+            f"{current / len(names):6.0f} bytes/module"
+        )
+
+
+def _benchmark_graph(arguments: argparse.Namespace, project: str) -> None:
+    graph = _generate_graph(arguments.nodes, arguments.edges_per_node)
+    print(f"{len(graph)} nodes, {graph.edge_count} edges")
+    for label, algorithm in (
+        ("strongly connected components", components._strongly_connected_components),
+        ("transitive reduction", components._transitive_reduction),
+    ):
+        start = time.perf_counter()
+        result = algorithm(graph)
+        elapsed = time.perf_counter() - start
+        if isinstance(result, components._DependencyGraph):
+            print(f"{label:>30}: {elapsed:8.3f} s  {result.edge_count} edges left")
+        else:
+            print(f"{label:>30}: {elapsed:8.3f} s")
+
+
+def _benchmark_write(arguments: argparse.Namespace, project: str) -> None:
+    graph = _generate_graph(arguments.nodes, arguments.edges_per_node)
+    print(f"{len(graph)} nodes, {graph.edge_count} edges")
+    for output_format, writer in sorted(components._WRITERS.items()):
+        text = io.StringIO()
+        writer(graph, text)
+        size = len(text.getvalue().encode())
+        # A line-buffered file behaves like standard output on a terminal.
+        for label, open_stream in (
+            ("line-buffered", lambda: open(os.devnull, "w", buffering=1)),
+            ("string", io.StringIO),
+        ):
+            for chunked in (False, True):
+                with open_stream() as stream:
+                    start = time.perf_counter()
+                    if chunked:
+                        with components._ChunkedWriter(stream) as chunks:
+                            writer(graph, chunks)
+                    else:
+                        writer(graph, stream)
+                    elapsed = time.perf_counter() - start
+                print(
+                    f"{output_format:>8} {label:>13} {'chunked' if chunked else 'direct':>7}: "
+                    f"{elapsed:8.3f} s  {size / 2**20 / elapsed:8.1f} MiB/s"
+                )
+
+
+def _benchmark_frames(arguments: argparse.Namespace, project: str) -> None:
+    packages = [()]
+    level = [()]
+    for _ in range(arguments.depth):
+        level = [
+            p + (f"package_{i}",) for p in level for i in range(arguments.branching)
+        ]
+        packages.extend(level)
+    modules = [
+        components._Module(".".join(package + (f"module_{i}",)), "")
+        for package in packages
+        for i in range(arguments.modules_per_package)
+    ]
+    print(f"{len(packages) - 1} packages, {len(modules)} modules")
+    with tempfile.TemporaryDirectory() as output:
+        for label, write in (
+            ("frame per module", _write_frames_per_module),
+            ("package tree", components._write_module_to_diagram),
+        ):
+            text = io.StringIO()
+            start = time.perf_counter()
+            text.write("@startuml\n")
+            write(modules, text)
+            text.write("@enduml\n")
+            elapsed = time.perf_counter() - start
+            path = os.path.join(output, label.replace(" ", "_") + ".puml")
+            with open(path, "w") as f:
+                f.write(text.getvalue())
+            result = (
+                f"{label:>16}: {len(text.getvalue()) / 2**10:8.0f} KiB  "
+                f"written in {elapsed:6.3f} s"
+            )
+            if shutil.which("plantuml"):
+                start = time.perf_counter()
+                components._run_plantuml(path, arguments.image_type)
+                result += f"  rendered in {time.perf_counter() - start:8.3f} s"
+            print(result)
+
+
+def _write_frames_per_module(modules: list, plantuml_file) -> None:
+    """The module writer before it built a package tree, for comparison."""
+    for module in modules:
+        for i, package in enumerate(module.packages):
+            plantuml_file.write(
+                f"frame {package} as {'.'.join(module.packages[:i+1])} {{\n"
+            )
+        plantuml_file.write(f"[{module.name}] as {module.full_name}\n")
+        for package in module.packages:
+            plantuml_file.write("}\n")
+
+
+def _benchmark_render(arguments: argparse.Namespace, project: str) -> None:
+    scan = components._Project(components._parse_command_line(["--no-cache", project]))
+    scan.scan()
+    with tempfile.TemporaryDirectory() as output:
+        for output_format, program in (("plantuml", "plantuml"), ("dot", "dot")):
+            if not shutil.which(program):
+                print(f"{output_format:>8}: skipped, {program} is not installed")
+                continue
+            options = components._parse_command_line(
+                [
+                    "--no-cache",
+                    "--format",
+                    output_format,
+                    "--output-file",
+                    os.path.join(output, "components." + output_format),
+                    "--image-type",
+                    arguments.image_type,
+                    project,
+                ]
+            )
+            start = time.perf_counter()
+            components._write_output(scan, options)
+            elapsed = time.perf_counter() - start
+            print(f"{output_format:>8}: {elapsed:8.3f} s")
+
+
+def _generate_graph(
+    node_count: int, edges_per_node: int
+) -> components._DependencyGraph:
+    """
+    Build a synthetic dependency graph.
+
+    Most edges point to later nodes, like a layered project, but some point back and form
+    cycles.
+    """
+    generator = random.Random(0)
+    modules = [
+        components._Module(f"package_{i % 50}.module_{i}", "")
+        for i in range(node_count)
+    ]
+    sources = array.array("i")
+    targets = array.array("i")
+    for node in range(node_count):
+        for _ in range(edges_per_node):
+            if generator.random() < 0.05:
+                target = generator.randrange(node_count)
+            else:
+                target = min(node_count - 1, node + 1 + generator.randrange(100))
+            if target != node:
+                sources.append(node)
+                targets.append(target)
+    return components._DependencyGraph(modules, sources, targets)
+
+
+class _DictionaryModule:
+    """The module representation before it was slotted, for comparison."""
+
+    def __init__(self, name: str, path: str) -> None:
+        self.full_name = name
+        self.path = path
+        self.dependencies = []
+        split_name = name.split(".")
+        self.packages = split_name[:-1]
+        self.name = split_name[-1]
+
+
+@contextlib.contextmanager
+def _count_stat_calls():
+    """Count the calls to :py:func:`os.stat` made inside the ``with`` block."""
+    counter = [0]
+    stat = os.stat
+
+    def counting_stat(*args, **kwargs):
+        counter[0] += 1
+        return stat(*args, **kwargs)
+
+    os.stat = counting_stat
+    try:
+        yield counter
+    finally:
+        os.stat = stat
+
+
+if __name__ == "__main__":
+    main()
@@ -1,184 +1,2864 @@
 """Generate a component diagram of modules."""
 
+import argparse
+import array
+import ast
+import concurrent.futures
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import hashlib
+import json
+import multiprocessing
+import os.path
+import re
+import select
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import time
+import tokenize
+import typing
+
+
+def main() -> None:
+    arguments = _parse_command_line()
+    cache, digests = (None, None) if arguments.no_cache else _open_caches(arguments)
+    executor = _make_executor(arguments.jobs)
+    renderer = _make_renderer(arguments)
+    try:
+        if arguments.batch:
+            _run_batch(arguments, cache, digests, executor, renderer)
+            return
+        project = _Project(arguments, cache, executor)
+        project.scan()
+        if cache:
+            cache.commit()
+            if arguments.cache_stats:
+                print(
+                    f"Import cache: {cache.hits} hits, {cache.misses} misses.",
+                    file=sys.stderr,
+                )
+        _write_output(project, arguments, renderer, digests)
+        if arguments.watch:
+            try:
+                _watch(project, arguments, renderer, cache, digests)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        # Shut the workers down first, in case one of them holds a renderer's pipe open.
+        if executor:
+            executor.shutdown()
+        renderer.close()
+        if cache:
+            cache.close()
+        if digests:
+            digests.close()
+
+
+def _open_caches(arguments: argparse.Namespace) -> tuple:
+    """
+    Open the import cache and the output digests.
+
+    The caches only save time, so if they cannot be opened, for example because the project is
+    read-only, the run goes on without them.
+
+    Args:
+        arguments (argparse.Namespace): The command line arguments.
+
+    Returns:
+        tuple: The :py:class:`_ImportCache` and the :py:class:`_OutputDigests`, or two ``None``
+        values if they cannot be opened.
+    """
+    cache = None
+    try:
+        cache = _ImportCache(arguments.cache_dir)
+        return cache, _OutputDigests(arguments.cache_dir)
+    except (OSError, sqlite3.Error) as error:
+        print(
+            f"Cannot open the cache in {arguments.cache_dir}, continuing without it: "
+            f"{error}",
+            file=sys.stderr,
+        )
+        if cache:
+            cache.close()
+        return None, None
+
+
+def _make_executor(jobs: int) -> concurrent.futures.Executor:
+    """
+    Create the pool of worker processes for extracting imports.
+
+    The workers are started lazily, possibly after a PlantUML process has been started with
+    a pipe to its standard input. Where it is available, the ``forkserver`` start method is
+    used, so that the workers do not inherit the pipe and keep PlantUML from exiting.
+
+    Args:
+        jobs (int): The number of worker processes.
+
+    Returns:
+        concurrent.futures.Executor: The pool, or ``None`` if ``jobs`` is 1.
+    """
+    if jobs <= 1:
+        return None
+    start_method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else None
+    )
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context(start_method)
+    )
+
+
+class _Module:
+    """
+    Encapsulates the data about a module in the Python project.
+
+    Names are interned, and modules in the same package share one ``packages`` tuple, so a
+    large project holds one copy of each name.
+
+    Attributes:
+        id (int): The module's index in its :py:class:`_ModuleRegistry`, or -1 if it is not in
+            a registry.
+        full_name (str): The fully qualified name of the module, like ``package.package.module``.
+        path (str): The path to the module on disk.
+        packages (tuple): The names of the packages containing the module, outermost first.
+        name (str): The name of the module, without its packages.
+        dependencies (array.array): The IDs of the modules that this module imports.
+        lines (array.array): The line of the first import of each dependency, in the same
+            order as ``dependencies``. This is empty if the lines are not known.
+    """
+
+    __slots__ = ("id", "full_name", "path", "packages", "name", "dependencies", "lines")
+
+    def __init__(self, name: str, path: str, dependencies: array.array = None) -> None:
+        self.id = -1
+        self.full_name = sys.intern(name)
+        self.path = path
+        self.dependencies = array.array("i") if dependencies is None else dependencies
+        self.lines = array.array("i")
+        split_name = self.full_name.split(".")
+        self.packages = _intern_packages(split_name[:-1])
+        self.name = sys.intern(split_name[-1])
+
+    def __str__(self):
+        """
+        Describe the module for debugging.
+
+        The dependencies are shown as registry IDs, because a module cannot look up names.
+        Use :py:meth:`_ModuleRegistry.by_id` to find the modules they stand for.
+        """
+        return f"{self.full_name}\n  {self.path}\n  " + (
+            "dependency IDs: " + ",".join(str(d) for d in self.dependencies)
+            if self.dependencies
+            else "<no dependencies>"
+        )
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+# The shared package tuples, so that modules in the same package do not each hold a copy.
+_PACKAGES = {}
+
+
+def _intern_packages(packages: list) -> tuple:
+    packages = tuple(sys.intern(package) for package in packages)
+    return _PACKAGES.setdefault(packages, packages)
+
+
+class _ModuleRegistry:
+    """
+    The modules in a project, indexed by full name and by ID.
+
+    Besides looking up a module by name in constant time, the registry keeps a tree of the
+    package names so that :py:meth:`under` can find the modules in a package without visiting
+    the rest of the project.
+    """
+
+    def __init__(self, modules: list = ()) -> None:
+        self._modules = {}
+        self._table = []
+        self._root = _PackageNode()
+        for module in modules:
+            self.add(module)
+
+    def add(self, module: _Module) -> None:
+        """
+        Add a module, replacing any module with the same full name.
+
+        The module's ``id`` is set to its index in the registry. A replacement takes the ID of
+        the module it replaces.
+        """
+        existing = self._modules.get(module.full_name)
+        if existing is None:
+            module.id = len(self._table)
+            self._table.append(module)
+        else:
+            module.id = existing.id
+            self._table[module.id] = module
+        self._modules[module.full_name] = module
+        node = self._root
+        for segment in module.full_name.split("."):
+            node = node.children.setdefault(segment, _PackageNode())
+        node.module = module
+
+    def under(self, package: str) -> list:
+        """
+        Find the modules in a package.
+
+        Args:
+            package (str): The full name of the package, like ``package.package``.
+
+        Returns:
+            list: The module named ``package``, if there is one, and every module in the
+            package and its subpackages.
+        """
+        node = self._root
+        for segment in package.split("."):
+            node = node.children.get(segment)
+            if node is None:
+                return []
+        modules = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.module is not None:
+                modules.append(node.module)
+            nodes.extend(node.children.values())
+        return modules
+
+    def get(self, full_name: str, default=None):
+        return self._modules.get(full_name, default)
+
+    def by_id(self, module_id: int) -> _Module:
+        """Get the module with this ID."""
+        return self._table[module_id]
+
+    def __getitem__(self, full_name: str) -> _Module:
+        return self._modules[full_name]
+
+    def __contains__(self, full_name: str) -> bool:
+        return full_name in self._modules
+
+    def __iter__(self):
+        return iter(self._modules.values())
+
+    def __len__(self) -> int:
+        return len(self._modules)
+
+
+class _PackageNode:
+    """
+    One level of the package tree in :py:class:`_ModuleRegistry`.
+
+    Attributes:
+        children (dict): The nodes one level down, by name.
+        module (_Module): The module with this node's full name, or ``None`` if no module
+            has that name.
+    """
+
+    __slots__ = ("children", "module")
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.module = None
+
+
+class _DependencyGraph:
+    """
+    The dependencies between modules, stored as integer adjacency arrays.
+
+    Nodes are numbered densely from 0, and node ``i`` is ``modules[i]``. Edges are stored in
+    compressed sparse row form: the successors of node ``i`` are
+    ``targets[offsets[i]:offsets[i + 1]]``. The reverse edges are stored the same way, so
+    both :py:meth:`successors` and :py:meth:`predecessors` take time proportional to the
+    number of neighbours.
+
+    Attributes:
+        modules (list): The module for each node.
+        offsets (array.array): The start of each node's successors in ``targets``, plus the
+            total number of edges.
+        targets (array.array): The successors of every node.
+        reverse_offsets (array.array): The start of each node's predecessors in ``sources``,
+            plus the total number of edges.
+        sources (array.array): The predecessors of every node.
+        weights (array.array): The weight of each edge, in the same order as ``targets``, or
+            ``None`` if the edges are not weighted.
+    """
+
+    def __init__(self, modules: list, sources, targets, weights=None) -> None:
+        """
+        Args:
+            modules (list): The module for each node.
+            sources: The source node of each edge.
+            targets: The target node of each edge, in the same order as ``sources``.
+            weights: The weight of each edge, in the same order as ``sources``, or ``None``.
+        """
+        self.modules = modules
+        self.offsets, self.targets = _compress_rows(len(modules), sources, targets)
+        self.weights = None
+        if weights is not None:
+            _, self.weights = _compress_rows(len(modules), sources, weights)
+        self.reverse_offsets, self.sources = _compress_rows(
+            len(modules), targets, sources
+        )
+
+    @classmethod
+    def from_modules(cls, modules: list, registry: _ModuleRegistry):
+        """
+        Build the graph of the dependencies between some modules.
+
+        Args:
+            modules (list): The modules to include, in node order.
+            registry (_ModuleRegistry): The registry that assigned the IDs in the modules'
+                ``dependencies``.
+
+        Returns:
+            _DependencyGraph: The graph. Dependencies on modules that are not in ``modules``
+            are left out.
+        """
+        nodes = {module.id: node for node, module in enumerate(modules)}
+        sources = array.array("i")
+        targets = array.array("i")
+        for node, module in enumerate(modules):
+            for dependency in module.dependencies:
+                target = nodes.get(dependency)
+                if target is not None:
+                    sources.append(node)
+                    targets.append(target)
+        return cls(modules, sources, targets)
+
+    def successors(self, node: int) -> array.array:
+        """Get the nodes that a node depends on."""
+        return self.targets[self.offsets[node] : self.offsets[node + 1]]
+
+    def predecessors(self, node: int) -> array.array:
+        """Get the nodes that depend on a node."""
+        return self.sources[self.reverse_offsets[node] : self.reverse_offsets[node + 1]]
+
+    def subgraph(self, nodes) -> "_DependencyGraph":
+        """
+        Get the subgraph induced by some nodes.
+
+        Args:
+            nodes: The nodes to keep.
+
+        Returns:
+            _DependencyGraph: The graph of the kept nodes, in their original order, and of
+            every edge between two of them.
+        """
+        kept = array.array("i", [-1]) * len(self.modules)
+        modules = []
+        for node in sorted(nodes):
+            kept[node] = len(modules)
+            modules.append(self.modules[node])
+        sources = array.array("i")
+        targets = array.array("i")
+        weights = None if self.weights is None else array.array("i")
+        for position, (source, target) in enumerate(self.edges()):
+            if kept[source] != -1 and kept[target] != -1:
+                sources.append(kept[source])
+                targets.append(kept[target])
+                if weights is not None:
+                    weights.append(self.weights[position])
+        return _DependencyGraph(modules, sources, targets, weights)
+
+    def sources_by_position(self) -> array.array:
+        """Get the source node of each edge, in the same order as ``targets``."""
+        sources = array.array("i", bytes(4 * len(self.targets)))
+        for node in range(len(self.modules)):
+            for position in range(self.offsets[node], self.offsets[node + 1]):
+                sources[position] = node
+        return sources
+
+    def edges(self):
+        """Generate each edge as a ``(source, target)`` tuple, in source order."""
+        offsets = self.offsets
+        for source in range(len(self.modules)):
+            for position in range(offsets[source], offsets[source + 1]):
+                yield source, self.targets[position]
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.targets)
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+
+def _strongly_connected_components(graph: _DependencyGraph) -> list:
+    """
+    Find the strongly connected components of a graph with Tarjan's algorithm.
+
+    The depth-first search keeps its own stack instead of recursing, so it works on graphs of
+    any depth.
+
+    Args:
+        graph (_DependencyGraph): The graph to search.
+
+    Returns:
+        list: The nodes of each component. The components are in reverse topological order:
+        each component comes after every component that it depends on.
+    """
+    offsets = graph.offsets
+    targets = graph.targets
+    index = array.array("i", [-1]) * len(graph)
+    low = array.array("i", [0]) * len(graph)
+    on_stack = bytearray(len(graph))
+    stack = []
+    components = []
+    counter = 0
+    for root in range(len(graph)):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        path = [root]
+        positions = [offsets[root]]
+        while path:
+            node = path[-1]
+            position = positions[-1]
+            end = offsets[node + 1]
+            while position < end:
+                successor = targets[position]
+                position += 1
+                if index[successor] == -1:
+                    positions[-1] = position
+                    index[successor] = low[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack[successor] = 1
+                    path.append(successor)
+                    positions.append(offsets[successor])
+                    break
+                if on_stack[successor] and index[successor] < low[node]:
+                    low[node] = index[successor]
+            else:
+                path.pop()
+                positions.pop()
+                if path and low[node] < low[path[-1]]:
+                    low[path[-1]] = low[node]
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def _find_cycles(graph: _DependencyGraph) -> list:
+    """
+    Find the import cycles in a graph.
+
+    Args:
+        graph (_DependencyGraph): The graph to search.
+
+    Returns:
+        list: The sorted nodes of each strongly connected component with more than one node,
+        ordered by their first node.
+    """
+    return sorted(
+        sorted(component)
+        for component in _strongly_connected_components(graph)
+        if len(component) > 1
+    )
+
+
+def _transitive_reduction(graph: _DependencyGraph) -> _DependencyGraph:
+    """
+    Remove the edges that are implied by longer paths.
+
+    The strongly connected components are condensed first. Between components, an edge is
+    kept only if its target cannot be reached through another of the source's dependencies,
+    which is checked against bitsets of the components reachable from each dependency. The
+    bitsets are built in reverse topological order and dropped once every component that
+    depends on them is done. Of several edges joining the same two components, only the
+    first is kept. Edges inside a component are all kept.
+
+    Args:
+        graph (_DependencyGraph): The graph to reduce.
+
+    Returns:
+        _DependencyGraph: A graph with the same nodes and the same reachability, and the
+        remaining edges in their original order.
+    """
+    components = _strongly_connected_components(graph)
+    component_of = array.array("i", bytes(4 * len(graph)))
+    for component, members in enumerate(components):
+        for member in members:
+            component_of[member] = component
+    offsets = graph.offsets
+    targets = graph.targets
+    kept = bytearray(graph.edge_count)
+    dependencies = [{} for _ in components]
+    for source in range(len(graph)):
+        source_component = component_of[source]
+        for position in range(offsets[source], offsets[source + 1]):
+            target_component = component_of[targets[position]]
+            if target_component == source_component:
+                kept[position] = 1
+            else:
+                dependencies[source_component].setdefault(target_component, position)
+    dependents = array.array("i", bytes(4 * len(components)))
+    for edges in dependencies:
+        for target_component in edges:
+            dependents[target_component] += 1
+    reachable = [0] * len(components)
+    for component, edges in enumerate(dependencies):
+        # Dependencies later in topological order cannot reach earlier ones, so visiting
+        # them in descending component order finds each implied edge.
+        reach = 0
+        for target_component in sorted(edges, reverse=True):
+            if not reach >> target_component & 1:
+                kept[edges[target_component]] = 1
+                reach |= reachable[target_component] | 1 << target_component
+            dependents[target_component] -= 1
+            if dependents[target_component] == 0:
+                reachable[target_component] = 0
+        if dependents[component] != 0:
+            reachable[component] = reach
+    sources = array.array("i")
+    reduced_targets = array.array("i")
+    weights = None if graph.weights is None else array.array("i")
+    for source in range(len(graph)):
+        for position in range(offsets[source], offsets[source + 1]):
+            if kept[position]:
+                sources.append(source)
+                reduced_targets.append(targets[position])
+                if weights is not None:
+                    weights.append(graph.weights[position])
+    return _DependencyGraph(graph.modules, sources, reduced_targets, weights)
+
+
+def _collapse(graph: _DependencyGraph, depth: int) -> _DependencyGraph:
+    """
+    Merge the modules in each package a number of levels deep into one node.
+
+    The merged edges are counted in one pass over the edge list. Dependencies between two
+    modules in the same node are left out.
+
+    Args:
+        graph (_DependencyGraph): The graph to collapse.
+        depth (int): The number of package levels to keep. Each module becomes the package
+            named by the first ``depth`` entries of its ``packages``. Modules in fewer
+            packages are kept.
+
+    Returns:
+        _DependencyGraph: The graph of the packages and kept modules, in the order they are
+        first found. Each edge's weight is the number of module dependencies merged into it,
+        or the sum of their weights if ``graph`` is already weighted.
+    """
+    nodes = {}
+    modules = []
+    node_of = array.array("i", bytes(4 * len(graph)))
+    for node, module in enumerate(graph.modules):
+        packages = module.packages
+        if len(packages) < depth:
+            name = module.full_name
+        else:
+            name = ".".join(packages[:depth])
+        collapsed = nodes.get(name)
+        if collapsed is None:
+            collapsed = nodes[name] = len(modules)
+            if name == module.full_name:
+                modules.append(module)
+            else:
+                modules.append(_Module(name, _package_path(module, depth)))
+        node_of[node] = collapsed
+    return _merge_nodes(graph, node_of, modules)
+
+
+def _merge_nodes(
+    graph: _DependencyGraph, node_of: array.array, modules: list
+) -> _DependencyGraph:
+    """
+    Merge the nodes of a graph and count the edges between the merged nodes.
+
+    Args:
+        graph (_DependencyGraph): The graph to merge.
+        node_of (array.array): The merged node for each node of ``graph``.
+        modules (list): The module for each merged node.
+
+    Returns:
+        _DependencyGraph: The weighted graph of the merged nodes, without self-loops.
+    """
+    weights = {}
+    for position, (source, target) in enumerate(graph.edges()):
+        edge = (node_of[source], node_of[target])
+        if edge[0] != edge[1]:
+            weights[edge] = weights.get(edge, 0) + (
+                1 if graph.weights is None else graph.weights[position]
+            )
+    return _DependencyGraph(
+        modules,
+        array.array("i", [source for source, _ in weights]),
+        array.array("i", [target for _, target in weights]),
+        array.array("i", weights.values()),
+    )
+
+
+def _package_path(module: _Module, depth: int) -> str:
+    """Get the directory of the package that holds a module, ``depth`` levels deep."""
+    path = module.path
+    for _ in range(len(module.packages) - depth + 1):
+        path = os.path.dirname(path)
+    return path
+
+
+# The shard that holds the modules outside any package.
+_TOP_LEVEL_SHARD = "__top_level__"
+
+
+def _shard_by_package(graph: _DependencyGraph, cycles: list = ()) -> tuple:
+    """
+    Split a graph into one shard for each top-level package.
+
+    Each shard holds its package's modules and the edges that start or end in them. The
+    modules at the other end of the edges that leave or enter the shard are added as stubs.
+    The edges are sorted into shards in one pass over the edge list.
+
+    Args:
+        graph (_DependencyGraph): The graph to split.
+        cycles (list): The import cycles to highlight, from :py:func:`_find_cycles`.
+
+    Returns:
+        tuple: The index graph, with one weighted node for each shard, and a list with a
+        ``(name, graph, cycles, stubs)`` tuple for each shard. The ``cycles`` and ``stubs``
+        are in terms of the shard's graph.
+    """
+    shards = {}
+    members = []
+    shard_of = array.array("i", bytes(4 * len(graph)))
+    index_modules = []
+    for node, module in enumerate(graph.modules):
+        name = module.packages[0] if module.packages else _TOP_LEVEL_SHARD
+        shard = shards.get(name)
+        if shard is None:
+            shard = shards[name] = len(members)
+            members.append([])
+            index_modules.append(
+                _Module(name, _package_path(module, 1 if module.packages else 0))
+            )
+        members[shard].append(node)
+        shard_of[node] = shard
+    edges = [[] for _ in members]
+    for position, (source, target) in enumerate(graph.edges()):
+        edges[shard_of[source]].append(position)
+        if shard_of[target] != shard_of[source]:
+            edges[shard_of[target]].append(position)
+    sources = graph.sources_by_position()
+    result = []
+    for shard, name in enumerate(shards):
+        nodes = set(members[shard])
+        for position in edges[shard]:
+            nodes.add(sources[position])
+            nodes.add(graph.targets[position])
+        nodes = sorted(nodes)
+        renumbered = {node: i for i, node in enumerate(nodes)}
+        positions = sorted(edges[shard])
+        shard_graph = _DependencyGraph(
+            [graph.modules[node] for node in nodes],
+            array.array("i", [renumbered[sources[p]] for p in positions]),
+            array.array("i", [renumbered[graph.targets[p]] for p in positions]),
+            (
+                None
+                if graph.weights is None
+                else array.array("i", [graph.weights[p] for p in positions])
+            ),
+        )
+        shard_cycles = (
+            [renumbered[node] for node in cycle if node in renumbered]
+            for cycle in cycles
+        )
+        result.append(
+            (
+                name,
+                shard_graph,
+                [cycle for cycle in shard_cycles if len(cycle) > 1],
+                {renumbered[node] for node in nodes if shard_of[node] != shard},
+            )
+        )
+    return _merge_nodes(graph, shard_of, index_modules), result
+
+
+def _neighbourhood(
+    graph: _DependencyGraph, roots: list, depth: int = None, direction: str = "both"
+) -> set:
+    """
+    Find the nodes near some nodes, with a breadth-first search.
+
+    Args:
+        graph (_DependencyGraph): The graph to search.
+        roots (list): The nodes to start from.
+        depth (int): The largest number of edges between a root and a found node, or
+            ``None`` for no limit.
+        direction (str): Follow dependencies ("out"), dependents ("in"), or both ("both").
+
+    Returns:
+        set: The roots and the nodes found.
+    """
+    adjacency = []
+    if direction in ("out", "both"):
+        adjacency.append((graph.offsets, graph.targets))
+    if direction in ("in", "both"):
+        adjacency.append((graph.reverse_offsets, graph.sources))
+    found = set(roots)
+    frontier = list(found)
+    distance = 0
+    while frontier and (depth is None or distance < depth):
+        distance += 1
+        next_frontier = []
+        for node in frontier:
+            for offsets, neighbours in adjacency:
+                for position in range(offsets[node], offsets[node + 1]):
+                    neighbour = neighbours[position]
+                    if neighbour not in found:
+                        found.add(neighbour)
+                        next_frontier.append(neighbour)
+        frontier = next_frontier
+    return found
+
+
+def _compress_rows(node_count: int, sources, targets) -> tuple:
+    """
+    Sort edges into compressed sparse row form, keeping the order of each node's edges.
+
+    Returns:
+        tuple: The ``offsets`` and ``targets`` arrays.
+    """
+    offsets = array.array("i", bytes(4 * (node_count + 1)))
+    for source in sources:
+        offsets[source + 1] += 1
+    for node in range(node_count):
+        offsets[node + 1] += offsets[node]
+    positions = offsets[:-1]
+    compressed = array.array("i", bytes(4 * len(targets)))
+    for source, target in zip(sources, targets):
+        compressed[positions[source]] = target
+        positions[source] += 1
+    return offsets, compressed
+
+
+class _Import(typing.NamedTuple):
+    """
+    One import statement, or one module of an ``import a, b`` statement.
+
+    Attributes:
+        module (str): The imported module, without leading dots. This is empty for statements
+            like ``from . import name``.
+        names (tuple): The names imported from the module by a ``from`` statement.
+        level (int): The number of leading dots in a relative import.
+        line (int): The line number of the statement.
+    """
+
+    module: str
+    names: tuple
+    level: int
+    line: int
+
+
+class _ImportCache:
+    """
+    A persistent store of the import records extracted from each file.
+
+    The cache lives in an SQLite database. An entry is valid while the file's modification time
+    and size match the stored values. If only the modification time changed, the cache compares
+    the file's content hash, so touching a file does not force a new extraction. Each extractor
+    has its own entries, so switching extractors does not evict the others' entries.
+
+    Attributes:
+        hits (int): The number of lookups that found valid imports.
+        misses (int): The number of lookups that did not.
+    """
+
+    # Increment this whenever the extracted data changes, to invalidate existing caches.
+    _VERSION = 3
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(directory, "imports.sqlite"))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        version = self._connection.execute(
+            "SELECT value FROM metadata WHERE key = 'version'"
+        ).fetchone()
+        if version is None or int(version[0]) != self._VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS imports")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('version', ?)",
+                (str(self._VERSION),),
+            )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS imports (path TEXT, extractor TEXT, "
+            "mtime_ns INTEGER, size INTEGER, digest TEXT, imports TEXT, "
+            "PRIMARY KEY (path, extractor))"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, path: str, stat: os.stat_result, extractor: str):
+        """
+        Find the cached imports for a file.
+
+        Args:
+            path (str): The path to the file.
+            stat (os.stat_result): The current status of the file.
+            extractor (str): The name of the extractor that must have produced the entry.
+
+        Returns:
+            list: The cached :py:class:`_Import` records, or ``None`` if the cache has no valid
+            entry for the file.
+        """
+        row = self._connection.execute(
+            "SELECT mtime_ns, size, digest, imports FROM imports "
+            "WHERE path = ? AND extractor = ?",
+            (path, extractor),
+        ).fetchone()
+        if row is None or row[1] != stat.st_size:
+            self.misses += 1
+            return None
+        if row[0] != stat.st_mtime_ns:
+            if _file_digest(path) != row[2]:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE imports SET mtime_ns = ? WHERE path = ? AND extractor = ?",
+                (stat.st_mtime_ns, path, extractor),
+            )
+        self.hits += 1
+        return [
+            _Import(module, tuple(names), level, line)
+            for module, names, level, line in json.loads(row[3])
+        ]
+
+    def store(
+        self,
+        path: str,
+        stat: os.stat_result,
+        extractor: str,
+        digest: str,
+        imports: list,
+    ) -> None:
+        """
+        Store the imports extracted from a file.
+
+        Args:
+            path (str): The path to the file.
+            stat (os.stat_result): The status of the file when the imports were extracted.
+            extractor (str): The name of the extractor that produced the imports.
+            digest (str): The hash of the file content, from :py:func:`_file_digest`.
+            imports (list): The :py:class:`_Import` records extracted from the file.
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                extractor,
+                stat.st_mtime_ns,
+                stat.st_size,
+                digest,
+                json.dumps(imports),
+            ),
+        )
+
+    def prune(self, root_path: str, paths: list) -> None:
+        """
+        Remove entries for files under ``root_path`` that are not in ``paths``.
+
+        Args:
+            root_path (str): The project directory, ending with a path separator.
+            paths (list): The files that currently exist in the project.
+        """
+        existing = set(paths)
+        stale = [
+            (path,)
+            for (path,) in self._connection.execute(
+                "SELECT DISTINCT path FROM imports WHERE substr(path, 1, ?) = ?",
+                (len(root_path), root_path),
+            )
+            if path not in existing
+        ]
+        self._connection.executemany("DELETE FROM imports WHERE path = ?", stale)
+
+    def commit(self) -> None:
+        """Write the changes to the cache to disk."""
+        self._connection.commit()
+
+    def close(self) -> None:
+        """Commit the changes to the cache and close it."""
+        self._connection.commit()
+        self._connection.close()
+
+
+class _OutputDigests:
+    """
+    A persistent record of the diagram that produced each output file.
+
+    Each entry holds the SHA-256 digest of the PlantUML text behind a diagram or image file,
+    along with the file's modification time and size when it was written. A file whose status
+    no longer matches was changed by something else, so it is not considered current.
+    """
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(directory, "outputs.sqlite"))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, digest TEXT, "
+            "mtime_ns INTEGER, size INTEGER)"
+        )
+
+    def is_current(self, path: str, digest: str) -> bool:
+        """
+        Check whether a file was produced from a diagram and has not changed since.
+
+        Args:
+            path (str): The path to the output file.
+            digest (str): The digest of the diagram's PlantUML text.
+
+        Returns:
+            bool: ``True`` if the file exists and was produced from the diagram.
+        """
+        row = self._connection.execute(
+            "SELECT digest, mtime_ns, size FROM outputs WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None or row[0] != digest:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == (row[1], row[2])
+
+    def store(self, path: str, digest: str) -> None:
+        """
+        Record that a file was just produced from a diagram.
+
+        Args:
+            path (str): The path to the output file.
+            digest (str): The digest of the diagram's PlantUML text.
+        """
+        stat = os.stat(path)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+            (path, digest, stat.st_mtime_ns, stat.st_size),
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class _Project:
+    """
+    The modules of a Python project and their dependencies.
+
+    The project keeps the import records of every scanned module in memory, so that
+    :py:meth:`update` only has to extract the imports of the files that changed.
+
+    If the arguments name entry modules, with ``--entry`` or with ``--focus`` and
+    ``--direction out``, only the modules reachable from them are scanned. The files are
+    parsed level by level, as the dependency edges reach them.
+
+    Attributes:
+        registry (_ModuleRegistry): Every module in the project, in path order.
+    """
+
+    def __init__(
+        self,
+        arguments: argparse.Namespace,
+        cache: _ImportCache = None,
+        executor: concurrent.futures.Executor = None,
+    ) -> None:
+        self._arguments = arguments
+        self._cache = cache
+        self._executor = executor
+        self._files = {}
+        self._imports = {}
+        self._directory_index = {}
+        self._reached = None
+        self.registry = _ModuleRegistry()
+        self._entries = arguments.entry
+        self._depth = None
+        if not self._entries and arguments.focus and arguments.direction == "out":
+            self._entries = arguments.focus
+            self._depth = arguments.depth
+
+    def find_files(self, directories: list = None) -> list:
+        """
+        Find the project's Python files, with :py:func:`_get_python_files`.
+
+        Args:
+            directories (list): If this is not ``None``, every directory searched is added
+                to it.
+        """
+        return _get_python_files(
+            self._arguments.project,
+            self._arguments.exclude,
+            not self._arguments.no_gitignore,
+            directories,
+        )
+
+    def scan(self) -> None:
+        """Find the modules in the project and their dependencies."""
+        python_files = self.find_files()
+        self._imports = {}
+        self._set_files(python_files)
+        self.registry = _ModuleRegistry(
+            _Module(self._module_name(f.path), f.path) for f in python_files
+        )
+        if self._entries:
+            self._traverse()
+        else:
+            self._extract(python_files)
+            self._resolve(self.registry)
+        if self._cache:
+            self._cache.prune(self._arguments.project, list(self._files))
+
+    def update(self, changed_paths: set) -> bool:
+        """
+        Update the project after files changed.
+
+        Args:
+            changed_paths (set): The paths of files that were created, modified or deleted.
+                Files that were created or deleted are also found by searching the project
+                again, so this only needs to be complete for modified files.
+
+        Returns:
+            bool: ``True`` if the modules, their dependencies or the lines of their imports
+            changed.
+        """
+        before = self._snapshot()
+        python_files = self.find_files()
+        current = {f.path for f in python_files}
+        added = current - self._files.keys()
+        removed = self._files.keys() - current
+        for path in removed | changed_paths:
+            self._imports.pop(path, None)
+        self._set_files(python_files)
+        if added or removed:
+            self.registry = _ModuleRegistry(
+                self.registry.get(self._module_name(f.path))
+                or _Module(self._module_name(f.path), f.path)
+                for f in python_files
+            )
+        if self._entries:
+            self._traverse()
+        else:
+            touched = [f for f in python_files if f.path not in self._imports]
+            self._extract(touched)
+            if added or removed:
+                self._resolve(self.registry)
+            else:
+                self._resolve(self.registry[self._module_name(f.path)] for f in touched)
+        return self._snapshot() != before
+
+    def modules(self) -> list:
+        """Get the modules to include in the diagram."""
+        return [
+            module
+            for module in self.registry
+            if (self._reached is None or module.id in self._reached)
+            and _include_module(module)
+        ]
+
+    def graph(self) -> _DependencyGraph:
+        """Get the dependency graph of the modules to include in the diagram."""
+        return _DependencyGraph.from_modules(self.modules(), self.registry)
+
+    def _module_name(self, path: str) -> str:
+        return _path_to_module_name(path, self._arguments.project)
+
+    def _set_files(self, python_files: list) -> None:
+        self._files = {f.path: f for f in python_files}
+        self._directory_index = _build_directory_index(self._files)
+
+    def _extract(self, python_files: list) -> None:
+        paths = [f.path for f in python_files]
+        records = _extract_all_imports(
+            paths,
+            self._arguments.jobs,
+            self._cache,
+            self._arguments.extractor,
+            python_files,
+            self._executor,
+        )
+        self._imports.update(zip(paths, records))
+
+    def _resolve(self, modules) -> None:
+        for module in modules:
+            lines = []
+            names = _get_imports(
+                module, self._imports[module.path], self._directory_index, lines
+            )
+            module.dependencies, module.lines = _filter_imports(
+                names, self.registry, lines
+            )
+
+    def _traverse(self) -> None:
+        """
+        Scan the modules reachable from the entry modules, one level at a time.
+
+        Each level's files are extracted together, so they can be spread across the worker
+        processes.
+        """
+        distances = {}
+        for name in self._entries:
+            for module in _find_modules(self.registry, name, self._arguments.project):
+                distances[module.id] = 0
+        level = [self.registry.by_id(module_id) for module_id in distances]
+        while level:
+            self._extract(
+                [self._files[m.path] for m in level if m.path not in self._imports]
+            )
+            self._resolve(level)
+            next_level = []
+            for module in level:
+                distance = distances[module.id] + 1
+                if self._depth is not None and distance > self._depth:
+                    continue
+                for dependency in module.dependencies:
+                    if dependency not in distances:
+                        distances[dependency] = distance
+                        next_level.append(self.registry.by_id(dependency))
+            level = next_level
+        self._reached = distances.keys()
+
+    def _snapshot(self) -> dict:
+        return {
+            m.full_name: (
+                tuple(self.registry.by_id(d).full_name for d in m.dependencies),
+                m.lines.tobytes(),
+            )
+            for m in self.modules()
+        }
+
+
+def _run_batch(
+    arguments: argparse.Namespace,
+    cache: _ImportCache,
+    digests: _OutputDigests,
+    executor: concurrent.futures.Executor,
+    renderer,
+) -> None:
+    """
+    Write the diagrams for every project in a batch manifest, and report their timing.
+
+    Args:
+        arguments (argparse.Namespace): The command line arguments, naming the manifest.
+        cache (_ImportCache): The import cache shared by every project.
+        digests (_OutputDigests): The output digests shared by every project.
+        executor (concurrent.futures.Executor): The worker pool shared by every project.
+        renderer: The image renderer shared by every project that uses the batch's --format.
+    """
+    with open(os.path.expanduser(arguments.batch), "r") as f:
+        manifest = json.load(f)
+    projects = [
+        (
+            entry.get("name"),
+            _parse_command_line([str(a) for a in entry.get("arguments", [])]),
+        )
+        for entry in manifest.get("projects", [])
+    ]
+    total_start = time.perf_counter()
+    for name, project_arguments in projects:
+        project_arguments.jobs = arguments.jobs
+        hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+        start = time.perf_counter()
+        project = _Project(project_arguments, cache, executor)
+        project.scan()
+        if cache:
+            cache.commit()
+        scanned = time.perf_counter()
+        _write_output(
+            project,
+            project_arguments,
+            renderer if project_arguments.format == arguments.format else None,
+            digests,
+        )
+        finished = time.perf_counter()
+        report = (
+            f"{name or project_arguments.project}: {len(project.modules())} modules, "
+            f"scan {scanned - start:.3f} s, output {finished - scanned:.3f} s"
+        )
+        if cache:
+            report += (
+                f", {cache.hits - hits} cache hits, {cache.misses - misses} misses"
+            )
+        print(report, file=sys.stderr)
+    print(
+        f"{len(projects)} projects in {time.perf_counter() - total_start:.3f} s",
+        file=sys.stderr,
+    )
+
+
+def _find_modules(registry: _ModuleRegistry, name: str, root_path: str) -> list:
+    """
+    Find the modules selected by a name on the command line.
+
+    Args:
+        registry (_ModuleRegistry): The modules in the project.
+        name (str): The full name of a module or package, or the path to a module file,
+            either absolute or relative to the project.
+        root_path (str): The project directory.
+
+    Returns:
+        list: The named module, or the modules in the named package.
+    """
+    name = _module_argument_name(name, root_path)
+    modules = registry.under(name)
+    if not modules:
+        sys.exit(f"There is no module or package named {name} in the project.")
+    return modules
+
+
+def _module_argument_name(name: str, root_path: str) -> str:
+    """
+    Turn a module named on the command line into a full module name.
+
+    Args:
+        name (str): The full name of a module or package, or the path to a module file,
+            either absolute or relative to the project.
+        root_path (str): The project directory.
+
+    Returns:
+        str: The full name of the module or package.
+    """
+    if name.endswith(".py"):
+        path = os.path.join(root_path, os.path.expanduser(name))
+        if not os.path.exists(path):
+            path = os.path.abspath(os.path.expanduser(name))
+        name = _path_to_module_name(path, root_path)
+    return name
+
+
+def _write_output(
+    project: _Project,
+    arguments: argparse.Namespace,
+    renderer=None,
+    digests: _OutputDigests = None,
+) -> None:
+    """
+    Write the diagram, and render its image if the arguments ask for one.
+
+    Args:
+        project (_Project): The project to draw.
+        arguments (argparse.Namespace): The command line arguments.
+        renderer: The renderer for images, from :py:func:`_make_renderer`. If this is
+            ``None``, a renderer is made for the one image.
+        digests (_OutputDigests): The digests of the diagrams previously written. The output
+            file is only rewritten, and the image only rendered, if the diagram differs from
+            the one that produced them. If this is ``None``, the output is always written.
+    """
+    graph = project.graph()
+    if arguments.focus:
+        graph = graph.subgraph(
+            _neighbourhood(
+                graph,
+                _find_nodes(
+                    graph, project.registry, arguments.focus, arguments.project
+                ),
+                arguments.depth,
+                arguments.direction,
+            )
+        )
+    if arguments.collapse_depth:
+        graph = _collapse(graph, arguments.collapse_depth)
+    cycles = []
+    if arguments.cycles or arguments.highlight_cycles:
+        cycles = _find_cycles(graph)
+    if arguments.cycles:
+        _report_cycles(graph, cycles)
+    if arguments.transitive_reduction:
+        graph = _transitive_reduction(graph)
+    writer = _WRITERS[arguments.format]
+    highlighted_cycles = cycles if arguments.highlight_cycles else ()
+    if not arguments.output_file:
+        with _ChunkedWriter(sys.stdout) as stream:
+            writer(graph, stream, highlighted_cycles)
+        return
+    if arguments.shard_by:
+        index, shards = _shard_by_package(graph, highlighted_cycles)
+        diagrams = [(arguments.output_file, index, (), ())] + [
+            (_shard_path(arguments.output_file, name), *shard)
+            for name, *shard in shards
+        ]
+    else:
+        diagrams = [(arguments.output_file, graph, highlighted_cycles, ())]
+    written = []
+    for path, diagram_graph, diagram_cycles, stubs in diagrams:
+        digest = _write_diagram(
+            writer, diagram_graph, diagram_cycles, stubs, path, digests
+        )
+        written.append((path, digest))
+    if arguments.image_types:
+        own_renderer = None if renderer else _make_renderer(arguments)
+        try:
+            _render_images(renderer or own_renderer, arguments, written, digests)
+        finally:
+            if own_renderer:
+                own_renderer.close()
+
+
+def _write_diagram(
+    writer,
+    graph: _DependencyGraph,
+    cycles: list,
+    stubs,
+    path: str,
+    digests: _OutputDigests,
+) -> str:
+    """
+    Write a diagram to a file, unless the file already holds the same diagram.
+
+    The diagram is streamed to a temporary file next to ``path`` while it is hashed, so it is
+    never held in memory as a whole. The temporary file replaces ``path`` only if the digest
+    differs from the one stored for it, so an unchanged file keeps its modification time. If
+    ``path`` is a symbolic link, the file it points to is replaced, and keeps its mode.
+
+    Args:
+        writer: The diagram writer, from ``_WRITERS``.
+        graph (_DependencyGraph): The graph to draw.
+        cycles (list): The import cycles to highlight.
+        stubs: The nodes that belong to another shard.
+        path (str): The path of the file to write.
+        digests (_OutputDigests): The digests of the files previously written, or ``None``
+            to always write the file.
+
+    Returns:
+        str: The SHA-256 digest of the diagram.
+    """
+    target_path = os.path.realpath(path)
+    temporary_path = f"{target_path}.{os.getpid()}.tmp"
+    digest = hashlib.sha256()
+    try:
+        with open(temporary_path, "w") as diagram_file:
+            with _ChunkedWriter(diagram_file, digest=digest) as stream:
+                writer(graph, stream, cycles, stubs)
+        digest = digest.hexdigest()
+        if digests is None or not digests.is_current(path, digest):
+            if os.path.exists(target_path):
+                shutil.copymode(target_path, temporary_path)
+            os.replace(temporary_path, target_path)
+            if digests:
+                digests.store(path, digest)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return digest
+
+
+def _shard_path(output_file: str, shard: str) -> str:
+    root, extension = os.path.splitext(output_file)
+    return f"{root}.{shard}{extension}"
+
+
+def _render_images(
+    renderer, arguments: argparse.Namespace, diagrams: list, digests: _OutputDigests
+) -> None:
+    """
+    Render the images of the diagrams that changed, and report the time each one took.
+
+    The images are rendered on up to --jobs threads, or one per image type if there are more
+    types. Each render runs in a separate process, so threads are enough to run them together.
+    A renderer that is not thread safe renders each image type on one thread.
+
+    Args:
+        renderer: The renderer for images, from :py:func:`_make_renderer`.
+        arguments (argparse.Namespace): The command line arguments.
+        diagrams (list): The path and digest of each diagram.
+        digests (_OutputDigests): The digests of the images previously rendered, or ``None``
+            to render every image.
+    """
+    stale = []
+    for path, digest in diagrams:
+        for image_type in arguments.image_types:
+            image_file = renderer.image_path(path, image_type)
+            if digests is None or not digests.is_current(image_file, digest):
+                stale.append((path, image_type, image_file, digest))
+    if renderer.thread_safe:
+        batches = [[image] for image in stale]
+    else:
+        by_type = {}
+        for image in stale:
+            by_type.setdefault(image[1], []).append(image)
+        batches = list(by_type.values())
+
+    def render(batch: list) -> list:
+        times = []
+        for path, image_type, image_file, _ in batch:
+            start = time.perf_counter()
+            renderer.render(path, image_type)
+            times.append((image_file, time.perf_counter() - start))
+        return times
+
+    workers = min(len(batches), max(arguments.jobs, len(arguments.image_types)))
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(render, batches))
+    else:
+        results = [render(batch) for batch in batches]
+    for times in results:
+        for image_file, elapsed in times:
+            print(f"Rendered {image_file} in {elapsed:.2f} s.", file=sys.stderr)
+    if digests:
+        for _, _, image_file, digest in stale:
+            digests.store(image_file, digest)
+
+
+def _find_nodes(
+    graph: _DependencyGraph, registry: _ModuleRegistry, names: list, root_path: str
+) -> list:
+    """
+    Find the graph nodes for module or package names.
+
+    Args:
+        graph (_DependencyGraph): The graph to search.
+        registry (_ModuleRegistry): The registry of the modules in the graph.
+        names (list): Full names of modules or packages, or paths to module files, as
+            accepted by :py:func:`_find_modules`. A package selects all the modules in it.
+        root_path (str): The project directory.
+
+    Returns:
+        list: The nodes of the named modules.
+    """
+    nodes = {module.id: node for node, module in enumerate(graph.modules)}
+    found = []
+    for name in names:
+        name = _module_argument_name(name, root_path)
+        matches = [
+            nodes[module.id] for module in registry.under(name) if module.id in nodes
+        ]
+        if not matches:
+            sys.exit(f"There is no module or package named {name} in the diagram.")
+        found.extend(matches)
+    return found
+
+
+def _report_cycles(graph: _DependencyGraph, cycles: list) -> None:
+    """Print the import cycles to standard error."""
+    if not cycles:
+        print("No import cycles.", file=sys.stderr)
+        return
+    print(f"{len(cycles)} import cycles:", file=sys.stderr)
+    for cycle in cycles:
+        print(
+            f"  {len(cycle)} modules: "
+            + ", ".join(graph.modules[node].full_name for node in cycle),
+            file=sys.stderr,
+        )
+
+
+def _watch(
+    project: _Project,
+    arguments: argparse.Namespace,
+    renderer=None,
+    cache: _ImportCache = None,
+    digests: _OutputDigests = None,
+) -> None:
+    """
+    Update the output whenever the project's dependencies change.
+
+    This runs until it is interrupted. Only the files that change are scanned again, and the
+    output is only rewritten if the dependency graph changed.
+
+    Args:
+        project (_Project): The project, which must already be scanned.
+        arguments (argparse.Namespace): The command line arguments.
+        renderer: The renderer for images, from :py:func:`_make_renderer`.
+        cache (_ImportCache): The project's import cache, which is committed after each
+            update.
+        digests (_OutputDigests): The digests of the diagrams previously written.
+    """
+    watcher = None
+    if not arguments.poll:
+        try:
+            directories = []
+            project.find_files(directories)
+            watcher = _InotifyWatcher(directories)
+        except OSError:
+            pass
+    if watcher is None:
+        watcher = _PollingWatcher(project.find_files, arguments.poll_interval)
+    print(f"Watching {arguments.project} for changes.", file=sys.stderr)
+    while True:
+        changed_paths = watcher.wait()
+        if project.update(changed_paths):
+            _write_output(project, arguments, renderer, digests)
+            print(f"Updated {arguments.output_file}.", file=sys.stderr)
+        if cache:
+            cache.commit()
+
+
+class _PollingWatcher:
+    """Find changed files by comparing the status of every file at an interval."""
+
+    def __init__(self, find_files, interval: float) -> None:
+        """
+        Args:
+            find_files: A function that returns the :py:class:`os.DirEntry` of every file to
+                watch.
+            interval (float): The number of seconds between checks.
+        """
+        self._find_files = find_files
+        self._interval = interval
+        self._snapshot = self._take_snapshot()
+
+    def wait(self) -> set:
+        """
+        Wait until files change.
+
+        Returns:
+            set: The paths of the files that were created, modified or deleted.
+        """
+        while True:
+            time.sleep(self._interval)
+            snapshot = self._take_snapshot()
+            changed_paths = {
+                path
+                for path in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(path) != self._snapshot.get(path)
+            }
+            self._snapshot = snapshot
+            if changed_paths:
+                return changed_paths
+
+    def _take_snapshot(self) -> dict:
+        snapshot = {}
+        for entry in self._find_files():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+
+class _InotifyWatcher:
+    """
+    Find changed files with the Linux inotify API.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_ISDIR = 0x40000000
+    _MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    _EVENT = struct.Struct("iIII")
+
+    # Editors often save a file with several operations; wait this many seconds for the rest
+    # of them before reporting a change.
+    _SETTLE_TIME = 0.1
+
+    def __init__(self, directories: list) -> None:
+        """
+        Args:
+            directories (list): The directories to watch.
+        """
+        library = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or library is None:
+            raise OSError("inotify is only available on Linux.")
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        self._descriptor = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._descriptor < 0:
+            raise OSError(ctypes.get_errno(), "Cannot initialize inotify.")
+        self._directories = {}
+        for directory in directories:
+            self._add_watch(directory)
+
+    def wait(self) -> set:
+        """
+        Wait until files change.
+
+        Returns:
+            set: The paths of the Python files that were created, modified or deleted, and
+            of directories that were deleted.
+        """
+        changed_paths = set()
+        while not changed_paths:
+            data = os.read(self._descriptor, 65536)
+            while select.select([self._descriptor], [], [], self._SETTLE_TIME)[0]:
+                data += os.read(self._descriptor, 65536)
+            changed_paths = self._read_events(data)
+        return changed_paths
+
+    def _add_watch(self, directory: str) -> None:
+        descriptor = self._libc.inotify_add_watch(
+            self._descriptor, os.fsencode(directory), self._MASK
+        )
+        if descriptor >= 0:
+            self._directories[descriptor] = directory
+
+    def _read_events(self, data: bytes) -> set:
+        changed_paths = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            directory = self._directories.get(descriptor)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if not mask & self._IN_ISDIR:
+                if path.endswith(".py"):
+                    changed_paths.add(path)
+            elif mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                for root, _, files in os.walk(path):
+                    self._add_watch(root)
+                    changed_paths.update(
+                        os.path.join(root, f) for f in files if f.endswith(".py")
+                    )
+            else:
+                changed_paths.add(path)
+        return changed_paths
+
+
+def _parse_command_line(command_line: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Generate a dependency graph for a Python project.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--output-file",
+        help="Write the PlantUML text to this file. If you omit this, the application writes the "
+        "PlantUML text to standard output.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(_WRITERS),
+        default="plantuml",
+        help="The language of the diagram. With 'dot', --image-type runs the Graphviz 'dot' "
+        "program instead of PlantUML; see the Graphviz documentation for the output types. "
+        "'json' writes the modules, the dependencies with the line of each import, and the "
+        "packages as one document, and 'jsonl' writes one record per module. The JSON formats "
+        "cannot be rendered.",
+    )
+    parser.add_argument(
+        "--image-type",
+        dest="image_types",
+        help="Run PlantUML and write an image of this type. See the PlantUML documentation for "
+        "a list of acceptable types (https://plantuml.com/command-line#458de91d76a8569c). You just "
+        "need to use the format acronym, such as '--image-type=png' or '--image-type=scxml'. "
+        "Separate several types with commas, such as '--image-type=png,svg', to render them at "
+        "the same time. The time taken by each image is reported. This option requires "
+        "--output-file.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Extract imports with this many worker processes, and with --shard-by, render "
+        "this many images at a time. Use 0 to start one worker per CPU.",
+    )
+    parser.add_argument(
+        "--entry",
+        action="append",
+        metavar="MODULE",
+        help="Only scan and draw the modules that this module imports, directly or "
+        "indirectly. The module can be a full name, a package, or the path to a file. Files "
+        "are only read when an import reaches them. You can use this option more than once.",
+    )
+    parser.add_argument(
+        "--focus",
+        action="append",
+        metavar="MODULE",
+        help="Only draw the modules near this module or package, and the imports between "
+        "them. The module can be a full name, a package, or the path to a file. You can use "
+        "this option more than once.",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=1,
+        help="With --focus, draw the modules up to this many imports away from the focus.",
+    )
+    parser.add_argument(
+        "--direction",
+        choices=["in", "out", "both"],
+        default="both",
+        help="With --focus, follow the modules that the focus imports ('out'), the modules "
+        "that import the focus ('in'), or both.",
+    )
+    parser.add_argument(
+        "--cycles",
+        action="store_true",
+        help="Print the import cycles, the groups of modules that import each other "
+        "directly or indirectly, to standard error.",
+    )
+    parser.add_argument(
+        "--highlight-cycles",
+        action="store_true",
+        help="Draw the imports within each import cycle in red.",
+    )
+    parser.add_argument(
+        "--transitive-reduction",
+        action="store_true",
+        help="Leave out the imports that are implied by longer chains of imports. For "
+        "example, if a imports b, b imports c, and a imports c, leave out a --> c.",
+    )
+    parser.add_argument(
+        "--collapse-depth",
+        type=int,
+        metavar="N",
+        help="Draw packages instead of modules: merge the modules in each package N levels "
+        "deep into one component, and label each dependency with the number of module "
+        "imports it stands for. Modules in fewer than N packages are drawn as they are. This "
+        "is applied after --focus and before --cycles.",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["package"],
+        help="Split the diagram into one file for each top-level package, named like the "
+        "output file with the package name before the extension. Modules that depend on or "
+        "are imported by the package's modules are drawn as stubs. The output file itself "
+        "gets an index diagram of the packages, labelled with the number of imports between "
+        "them. Images of the files are rendered --jobs at a time. This option requires "
+        "--output-file.",
+    )
+    parser.add_argument(
+        "--renderer",
+        choices=["auto", "oneshot", "pipe"],
+        default="auto",
+        help="How to run PlantUML, when --format is 'plantuml'. 'oneshot' starts PlantUML for "
+        "each image. 'pipe' keeps PlantUML running and streams each diagram to it, so only the "
+        "first image pays for starting the JVM. 'auto' uses 'pipe' with --watch or --batch, "
+        "and 'oneshot' otherwise.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After writing the output, keep running and update it whenever the project's "
+        "dependencies change. This option requires --output-file.",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="With --watch, check for changes by polling the files instead of using inotify. "
+        "Polling is always used where inotify is not available.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="With --watch and polling, the number of seconds between checks.",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Skip files and directories that match this glob pattern. The pattern is matched "
+        "against the name and against the path relative to the project. You can use this "
+        "option more than once.",
+    )
+    parser.add_argument(
+        "--no-gitignore",
+        action="store_true",
+        help="Include files that the project's .gitignore files exclude.",
+    )
+    parser.add_argument(
+        "--extractor",
+        choices=sorted(_EXTRACTORS),
+        default="ast",
+        help="How to find the imports in each file. 'ast' parses the file and finds every "
+        "import statement. 'regex' only finds import statements that start at column 0. "
+        "'tokenize' reads each file only until the first top level statement that is not an "
+        "import, docstring, or if/try block; 'tokenize-full' reads the whole file to find "
+        "late imports.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Extract the imports from every file, and write and render every output, "
+        "without reading or updating the cache.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep the cache of imports and output digests in this directory. The default is "
+        ".components_cache in the project directory.",
+    )
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Print the number of import cache hits and misses to standard error.",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="MANIFEST",
+        help="Generate the diagrams for several projects, listed in this JSON file, sharing "
+        "one worker pool, cache and PlantUML renderer. The file holds an object with a "
+        "'projects' list. Each project is an object with a 'name' and an 'arguments' list "
+        "of command line arguments for that project. The --jobs, --no-cache, --cache-dir "
+        "and --renderer options of this command apply to every project; the project "
+        "argument is ignored.",
+    )
+    parser.add_argument(
+        "project",
+        help="The path to the Python project.",
+        nargs="?",
+        default=".",
+    )
+    arguments = parser.parse_args(command_line)
+    if arguments.batch and command_line is not None:
+        sys.exit("A project in a --batch manifest cannot use --batch.")
+    if arguments.batch and arguments.watch:
+        sys.exit("You cannot use --watch with --batch.")
+    if arguments.output_file:
+        arguments.output_file = os.path.abspath(
+            os.path.expanduser(arguments.output_file)
+        )
+    if arguments.image_types:
+        if not arguments.output_file:
+            sys.exit("Using --image-type requires also using --output-file.")
+        if arguments.format not in ("dot", "plantuml"):
+            sys.exit(f"You cannot use --image-type with --format {arguments.format}.")
+        arguments.image_types = list(
+            dict.fromkeys(
+                image_type.strip().lower()
+                for image_type in arguments.image_types.split(",")
+                if image_type.strip()
+            )
+        )
+    if arguments.watch and not arguments.output_file:
+        sys.exit("Using --watch requires also using --output-file.")
+    if arguments.shard_by and not arguments.output_file:
+        sys.exit("Using --shard-by requires also using --output-file.")
+    if arguments.depth < 0:
+        sys.exit("--depth must be zero or greater.")
+    if arguments.collapse_depth is not None and arguments.collapse_depth < 1:
+        sys.exit("--collapse-depth must be one or greater.")
+    if arguments.jobs < 0:
+        sys.exit("--jobs must be zero or greater.")
+    if arguments.jobs == 0:
+        arguments.jobs = os.cpu_count() or 1
+    arguments.project = os.path.abspath(os.path.expanduser(arguments.project))
+    if arguments.project[-1] != "/":
+        arguments.project = arguments.project + "/"
+    if arguments.cache_dir:
+        arguments.cache_dir = os.path.abspath(os.path.expanduser(arguments.cache_dir))
+    else:
+        arguments.cache_dir = os.path.join(arguments.project, ".components_cache")
+    return arguments
+
+
+def _path_to_module_name(path: str, root_path: str) -> str:
+    return path.replace(root_path, "").replace(".py", "").replace("/", ".")
+
+
+# Directories that never contain project modules. Hidden directories, such as .git and .venv,
+# are always skipped.
+_EXCLUDED_DIRECTORIES = frozenset(
+    ["__pycache__", "node_modules", "site-packages", "venv"]
+)
+
+# Build output directories. These are only skipped if they are not packages, because
+# projects also use the names for their own packages, like pip's operations.build.
+_BUILD_DIRECTORIES = frozenset(["build", "dist"])
+
+_THIS_FILE = os.path.abspath(__file__)
+
+
+def _get_python_files(
+    root_path: str,
+    excludes: list = (),
+    use_gitignore: bool = True,
+    directories: list = None,
+) -> list:
+    """
+    Find the Python files in a project.
+
+    Excluded directories are pruned before the walk descends into them, so their contents
+    are never listed. Symbolic links to directories are followed, but each directory is only
+    searched once, so links that form a loop do not make the walk run forever.
+
+    Args:
+        root_path (str): The project directory.
+        excludes (list): Glob patterns for files and directories to skip. Each pattern is
+            matched against the entry name and against its path relative to ``root_path``.
+        use_gitignore (bool): Skip files and directories excluded by ``.gitignore`` files in
+            the project.
+        directories (list): If this is not ``None``, every directory searched is added to it.
+
+    Returns:
+        list: An :py:class:`os.DirEntry` for each Python file, sorted by path. Later stages
+        can use the entries' cached file status instead of calling :py:func:`os.stat`.
+    """
+    if root_path[-1] != "/":
+        root_path = root_path + "/"
+    python_files = []
+    pending = [(root_path, [])]
+    visited = set()
+    while pending:
+        directory, ignore_rules = pending.pop()
+        try:
+            stat = os.stat(directory)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(directory) as scan:
+                entries = list(scan)
+        except OSError:
+            continue
+        names = {entry.name for entry in entries}
+        if directory != root_path and "pyvenv.cfg" in names:
+            continue
+        if directories is not None:
+            directories.append(directory)
+        if use_gitignore and ".gitignore" in names:
+            ignore_rules = ignore_rules + _read_gitignore(
+                os.path.join(directory, ".gitignore"), directory[len(root_path) :]
+            )
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            relative_path = entry.path[len(root_path) :]
+            if entry.is_dir():
+                if (
+                    entry.name not in _EXCLUDED_DIRECTORIES
+                    and not (
+                        entry.name in _BUILD_DIRECTORIES
+                        and not os.path.exists(os.path.join(entry.path, "__init__.py"))
+                    )
+                    and not entry.name.endswith(".egg-info")
+                    and not _is_excluded(entry.name, relative_path, excludes)
+                    and not _is_ignored(relative_path + "/", ignore_rules)
+                ):
+                    pending.append((entry.path + "/", ignore_rules))
+            elif (
+                entry.name.endswith(".py")
+                and not entry.name.endswith("conf.py")
+                and entry.path != _THIS_FILE
+                and entry.is_file()
+                and not _is_excluded(entry.name, relative_path, excludes)
+                and not _is_ignored(relative_path, ignore_rules)
+            ):
+                python_files.append(entry)
+    python_files.sort(key=lambda entry: entry.path)
+    return python_files
+
+
+def _is_excluded(name: str, relative_path: str, excludes: list) -> bool:
+    return any(
+        fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern)
+        for pattern in excludes
+    )
+
+
+def _read_gitignore(path: str, directory: str) -> list:
+    """
+    Read the rules in a ``.gitignore`` file.
+
+    This supports the common subset of the syntax: comments, negation with ``!``, patterns
+    anchored with ``/``, directory-only patterns ending with ``/``, and the ``*``, ``?``,
+    ``[...]`` and ``**`` wildcards.
+
+    Args:
+        path (str): The path to the ``.gitignore`` file.
+        directory (str): The directory containing the file, relative to the project and
+            ending with ``/``, or an empty string for the project directory.
+
+    Returns:
+        list: A ``(regular expression, negated)`` tuple for each rule. The expression matches
+        a path relative to the project; directory paths end with ``/``.
+    """
+    rules = []
+    try:
+        with open(path, "r", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        prefix = re.escape(directory)
+        if "/" in line:
+            line = line.lstrip("/")
+        else:
+            prefix += "(?:.*/)?"
+        suffix = "/" if directory_only else "/?"
+        rules.append(
+            (re.compile(prefix + _translate_glob(line) + suffix + r"\Z"), negated)
+        )
+    return rules
+
+
+def _translate_glob(pattern: str) -> str:
+    """Convert a ``.gitignore`` glob to a regular expression that does not match ``/``."""
+    expression = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            expression.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            expression.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            expression.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            expression.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            expression.append("[" + pattern[i + 1 : end].replace("!", "^", 1) + "]")
+            i = end + 1
+        else:
+            expression.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(expression)
+
+
+def _is_ignored(relative_path: str, ignore_rules: list) -> bool:
+    ignored = False
+    for expression, negated in ignore_rules:
+        if ignored == negated and expression.match(relative_path):
+            ignored = not negated
+    return ignored
+
+
+def _extract_all_imports(
+    paths: list,
+    jobs: int = 1,
+    cache: _ImportCache = None,
+    extractor: str = "ast",
+    files: list = None,
+    executor: concurrent.futures.Executor = None,
+) -> list:
+    """
+    Extract the import records from every file.
+
+    Args:
+        paths (list): The files to scan.
+        jobs (int): The number of worker processes to use.
+        cache (_ImportCache): The cache of import records, or ``None`` to scan every file.
+        extractor (str): The name of the import extractor to use, from ``_EXTRACTORS``.
+        files (list): The :py:class:`os.DirEntry` of each file, or ``None`` to get the file
+            status from :py:func:`os.stat`.
+        executor (concurrent.futures.Executor): The pool of workers to use, passed to
+            :py:func:`_map`.
+
+    Returns:
+        list: The :py:class:`_Import` records of each file, in the same order as ``paths``.
+    """
+    if cache is None:
+        return _map(_EXTRACTORS[extractor], paths, jobs, executor)
+    if files is None:
+        stats = [os.stat(path) for path in paths]
+    else:
+        stats = [f.stat() for f in files]
+    records = [cache.lookup(path, stat, extractor) for path, stat in zip(paths, stats)]
+    misses = [i for i, imports in enumerate(records) if imports is None]
+    extracted = _map(
+        functools.partial(_extract_imports_and_digest, _EXTRACTORS[extractor]),
+        [paths[i] for i in misses],
+        jobs,
+        executor,
+    )
+    for i, (imports, digest) in zip(misses, extracted):
+        cache.store(paths[i], stats[i], extractor, digest, imports)
+        records[i] = imports
+    return records
+
+
+def _map(
+    function, items: list, jobs: int, executor: concurrent.futures.Executor = None
+) -> list:
+    """
+    Apply a function to every item, optionally across worker processes.
+
+    Args:
+        function: The function to apply. It must be picklable if ``jobs`` is more than one.
+        items (list): The arguments for the function.
+        jobs (int): The number of worker processes to use.
+        executor (concurrent.futures.Executor): A pool of ``jobs`` workers to use. If this
+            is ``None`` and ``jobs`` is more than one, a pool is started for this call.
+
+    Returns:
+        list: The results, in the same order as ``items``.
+    """
+    if executor is not None and len(items) > 1:
+        return list(
+            executor.map(function, items, chunksize=_chunk_size(len(items), jobs))
+        )
+    if jobs <= 1 or len(items) < 2:
+        return [function(item) for item in items]
+    with _make_executor(jobs) as executor:
+        return list(
+            executor.map(function, items, chunksize=_chunk_size(len(items), jobs))
+        )
 
-import argparse
-import glob
-import os.path
-import re
-import subprocess
-import sys
 
+def _chunk_size(task_count: int, jobs: int) -> int:
+    """
+    Pick a chunk size that gives each worker a few chunks, to balance load without paying the
+    per-task submission overhead for every module.
+    """
+    return max(1, -(-task_count // (jobs * 4)))
 
-def main() -> None:
-    arguments = _parse_command_line()
-    python_files = _get_python_files(arguments.project)
-    modules = [
-        _Module(_path_to_module_name(f, arguments.project), f) for f in python_files
-    ]
-    module_names = [m.full_name for m in modules]
-    for module in modules:
-        module.dependencies = _filter_imports(_get_imports(module), module_names)
-    modules = [module for module in modules if _include_module(module)]
-    if arguments.output_file:
-        with open(arguments.output_file, "w") as plantuml_file:
-            _write_component_diagram(modules, plantuml_file)
-    else:
-        _write_component_diagram(modules, sys.stdout)
-    if arguments.image_type:
-        _run_plantuml(arguments.output_file, arguments.image_type)
 
+def _extract_imports_with_regex(path: str) -> list:
+    """
+    Extract the imports from a Python file by matching lines that start with ``import`` or
+    ``from``.
 
-class _Module:
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        list: The :py:class:`_Import` records found in the file. The records do not include the
+        imported names.
     """
-    Encapsulates the data about a module in the Python project.
+    import_expression = re.compile(r"^(?:import|from)\s+(\.*)([^\s]*)")
+    imports = []
+    with open(path, "r", errors="replace") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.startswith("import ") or line.startswith("from "):
+                match = import_expression.match(line)
+                if match:
+                    imports.append(_Import(match[2], (), len(match[1]), line_number))
+    return imports
 
-    Attributes:
-        full_name (str): The fully qualified name of the module, like ``package.package.module``.
-        path (str): The path to the module on disk.
-        dependencies (list): The list of modules that this module imports.
+
+# Matches the start of anything that could be an import statement, to find where parsing
+# can stop.
+_IMPORT_START_EXPRESSION = re.compile(
+    rb"(?:^|[;:])[ \t]*(?:import|from)\b", re.MULTILINE
+)
+
+
+def _extract_imports_with_ast(path: str) -> list:
     """
+    Extract the imports from a Python file by parsing it.
 
-    def __init__(self, name: str, path: str, dependencies: list = None) -> None:
-        self.full_name = name
-        self.path = path
-        self.dependencies = [] if dependencies is None else dependencies
-        split_name = name.split(".")
-        self.packages = split_name[:-1]
-        self.name = split_name[-1]
+    Only the source up to the end of the last line that looks like an import is parsed. If
+    that prefix is not valid Python, for example because it ends inside a multiline string,
+    the whole file is parsed. Files that are not valid Python fall back to
+    :py:func:`_extract_imports_with_regex`.
 
-    def __str__(self):
-        return f"{self.full_name}\n  {self.path}\n  " + (
-            ",".join(self.dependencies) if self.dependencies else "<no dependencies>"
-        )
+    Args:
+        path (str): The path to the file.
 
-    def __repr__(self) -> str:
-        return str(self)
+    Returns:
+        list: The :py:class:`_Import` records found in the file, in line order.
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    try:
+        try:
+            tree = ast.parse(source[: _import_prefix_end(source)])
+        except SyntaxError:
+            tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return _extract_imports_with_regex(path)
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend(_Import(a.name, (), 0, node.lineno) for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append(
+                _Import(
+                    node.module or "",
+                    tuple(a.name for a in node.names),
+                    node.level,
+                    node.lineno,
+                )
+            )
+    imports.sort(key=lambda i: i.line)
+    return imports
 
 
-def _parse_command_line() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(
-        description="Generate a dependency graph for a Python project.",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-    )
-    parser.add_argument(
-        "--output-file",
-        help="Write the PlantUML text to this file. If you omit this, the application writes the "
-        "PlantUML text to standard output.",
-    )
-    parser.add_argument(
-        "--image-type",
-        help="Run PlantUML and write an image of this type. See the PlantUML documentation for "
-        "a list of acceptable types (https://plantuml.com/command-line#458de91d76a8569c). You just "
-        "need to use the format acronym, such as '--image-type=png' or '--image-type=scxml'. This "
-        "option requires --output-file.",
-    )
-    parser.add_argument(
-        "project", help="The path to the Python project.", default=".",
-    )
-    arguments = parser.parse_args()
-    if arguments.output_file:
-        arguments.output_file = os.path.abspath(
-            os.path.expanduser(arguments.output_file)
-        )
-    if arguments.image_type:
-        if not arguments.output_file:
-            sys.exit("Using --image-type requires also using --output-file.")
-        arguments.image_type = arguments.image_type.lower()
-    arguments.project = os.path.abspath(os.path.expanduser(arguments.project))
-    if arguments.project[-1] != "/":
-        arguments.project = arguments.project + "/"
-    return arguments
+def _import_prefix_end(source: bytes) -> int:
+    """
+    Find the end of the last statement in ``source`` that looks like an import.
 
+    Args:
+        source (bytes): The content of a Python file.
 
-def _path_to_module_name(path: str, root_path: str) -> str:
-    return path.replace(root_path, "").replace(".py", "").replace("/", ".")
+    Returns:
+        int: The offset just past the end of the line that ends the statement, or 0 if
+        ``source`` has no import.
+    """
+    last = None
+    for last in _IMPORT_START_EXPRESSION.finditer(source):
+        pass
+    if last is None:
+        return 0
+    end = last.start()
+    if b"(" in source[end : _next_line(source, end)]:
+        end = source.find(b")", end)
+        if end == -1:
+            return len(source)
+    end = _next_line(source, end)
+    while end < len(source):
+        if not source[max(0, end - 3) : end].rstrip().endswith(b"\\"):
+            break
+        end = _next_line(source, end)
+    return end
 
 
-def _get_python_files(root_path: str) -> list:
-    if root_path[-1] != "/":
-        root_path = root_path + "/"
-    python_files = glob.glob(os.path.join(root_path, "**", "*.py"), recursive=True)
-    python_files = [
-        f
-        for f in python_files
-        if f != os.path.basename(__file__) and not f.endswith("conf.py")
-    ]
-    return python_files
+def _next_line(source: bytes, offset: int) -> int:
+    newline = source.find(b"\n", offset)
+    return len(source) if newline == -1 else newline + 1
 
 
-def _get_imports(module: _Module) -> list:
-    import_expression = re.compile(r"^(?:import|from)\s+([^\s]+)")
-    with open(module.path, "r") as f:
-        lines = [
-            line
-            for line in f.readlines()
-            if line.startswith("import ") or line.startswith("from ")
-        ]
+def _extract_imports_with_tokenize(path: str, full_scan: bool = False) -> list:
+    """
+    Extract the imports from a Python file by streaming its tokens.
+
+    The file is read one line at a time. Unless ``full_scan`` is set, reading stops at the
+    first top level statement that is not an import, a string, or part of an ``if`` or
+    ``try`` block, so the body of a large module is never read. Files that do not match
+    their declared encoding fall back to :py:func:`_extract_imports_with_regex`.
+
+    Args:
+        path (str): The path to the file.
+        full_scan (bool): Read the whole file, to find imports after the first definition.
+
+    Returns:
+        list: The :py:class:`_Import` records found in the file, in line order.
+    """
     imports = []
-    for line in lines:
-        match = import_expression.match(line)
-        if match:
-            imports.append(match[1])
-    imports = [i[1:] if i.startswith(".") else i for i in imports]
-    imports = _match_local_modules(imports, module)
+    with open(path, "rb") as f:
+        try:
+            _scan_tokens(tokenize.tokenize(f.readline), imports, full_scan)
+        except (tokenize.TokenError, SyntaxError):
+            pass
+        except UnicodeDecodeError:
+            return _extract_imports_with_regex(path)
     return imports
 
 
-def _match_local_modules(imports: list, module: _Module) -> list:
+# The top level statements that the tokenize extractor reads past when not scanning the
+# full file, so that guarded imports such as ``try: import x`` are found.
+_IMPORT_PREAMBLE_KEYWORDS = frozenset(
+    ["if", "elif", "else", "try", "except", "finally"]
+)
+
+_SKIPPED_TOKENS = frozenset([tokenize.NL, tokenize.COMMENT, tokenize.ENCODING])
+
+
+def _scan_tokens(tokens, imports: list, full_scan: bool) -> None:
+    indentation = 0
+    brackets = 0
+    line_start = True
+    statement_start = True
+    for token in tokens:
+        if token.type in _SKIPPED_TOKENS:
+            continue
+        if token.type == tokenize.ENDMARKER:
+            return
+        if token.type in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT):
+            if token.type == tokenize.INDENT:
+                indentation += 1
+            elif token.type == tokenize.DEDENT:
+                indentation -= 1
+            brackets = 0
+            line_start = statement_start = True
+            continue
+        if statement_start and token.type == tokenize.NAME:
+            if token.string in ("import", "from"):
+                statement = [token]
+                for token in tokens:
+                    if token.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                        line_start = True
+                        break
+                    if token.string == ";":
+                        break
+                    if token.type not in _SKIPPED_TOKENS:
+                        statement.append(token)
+                imports.extend(_parse_import_tokens(statement))
+                if token.type == tokenize.ENDMARKER:
+                    return
+                continue
+        if (
+            line_start
+            and indentation == 0
+            and not full_scan
+            and token.type != tokenize.STRING
+            and token.string not in _IMPORT_PREAMBLE_KEYWORDS
+        ):
+            return
+        line_start = statement_start = False
+        if token.type == tokenize.OP:
+            if token.string in ("(", "[", "{"):
+                brackets += 1
+            elif token.string in (")", "]", "}"):
+                brackets -= 1
+            elif token.string in (":", ";") and brackets == 0:
+                statement_start = True
+
+
+def _parse_import_tokens(statement: list) -> list:
+    """
+    Convert the tokens of one import statement to :py:class:`_Import` records.
+
+    Args:
+        statement (list): The tokens of the statement, starting with ``import`` or ``from``
+            and excluding the token that ends the statement.
+
+    Returns:
+        list: The records for the statement.
+    """
+    line = statement[0].start[0]
+    words = [t.string for t in statement if t.string not in ("(", ")")]
+    if words[0] == "import":
+        return [_Import(name, (), 0, line) for name in _split_import_names(words[1:])]
+    level = 0
+    position = 1
+    while position < len(words) and words[position] in (".", "..."):
+        level += len(words[position])
+        position += 1
+    end = words.index("import") if "import" in words else len(words)
+    return [
+        _Import(
+            "".join(words[position:end]),
+            tuple(_split_import_names(words[end + 1 :])),
+            level,
+            line,
+        )
+    ]
+
+
+def _split_import_names(words: list) -> list:
+    """Split ``a.b as c, d`` into the imported names ``a.b`` and ``d``."""
+    names = []
+    name = ""
+    alias = False
+    for word in words + [","]:
+        if word == ",":
+            if name:
+                names.append(name)
+            name = ""
+            alias = False
+        elif word == "as":
+            alias = True
+        elif not alias:
+            name += word
+    return names
+
+
+_EXTRACTORS = {
+    "ast": _extract_imports_with_ast,
+    "regex": _extract_imports_with_regex,
+    "tokenize": _extract_imports_with_tokenize,
+    "tokenize-full": functools.partial(_extract_imports_with_tokenize, full_scan=True),
+}
+
+
+def _extract_imports_and_digest(extractor, path: str) -> tuple:
+    return extractor(path), _file_digest(path)
+
+
+def _file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _get_imports(
+    module: _Module, imports: list, directory_index: dict = None, lines: list = None
+) -> list:
+    """
+    Resolve a module's import records to module names.
+
+    Args:
+        module (_Module): The importing module.
+        imports (list): The :py:class:`_Import` records extracted from the module.
+        directory_index (dict): The index of sibling modules, passed to
+            :py:func:`_match_local_modules`.
+        lines (list): If this is given, the line number of each returned name is appended
+            to it.
+
+    Returns:
+        list: The imported module names, with sibling imports converted to full names.
+        Relative imports are resolved against the module's package, going up one package
+        for each dot after the first, and a ``from . import name`` statement imports each
+        name as a module. Relative imports that go above the project are left out.
+    """
+    names = []
+    # The positions in names of the absolute imports, which may be sibling imports.
+    absolute = []
+    packages = module.packages
+    for i in imports:
+        if i.level:
+            if i.level - 1 > len(packages):
+                continue
+            package = packages[: len(packages) - i.level + 1]
+            names.extend(
+                ".".join(package + (name,))
+                for name in ((i.module,) if i.module else i.names)
+            )
+        elif i.module:
+            absolute.append(len(names))
+            names.append(i.module)
+        else:
+            continue
+        if lines is not None:
+            lines.extend([i.line] * (len(names) - len(lines)))
+    matched = _match_local_modules(
+        [names[position] for position in absolute], module, directory_index
+    )
+    for position, name in zip(absolute, matched):
+        names[position] = name
+    return names
+
+
+def _build_directory_index(python_files: list) -> dict:
+    """
+    Index the module file names in each directory.
+
+    Args:
+        python_files (list): The paths of the Python files in the project.
+
+    Returns:
+        dict: A map from each directory to the set of file names in it, without the ``.py``
+        extension.
+    """
+    index = {}
+    for path in python_files:
+        directory, file_name = os.path.split(path)
+        index.setdefault(directory, set()).add(file_name[:-3])
+    return index
+
+
+def _match_local_modules(
+    imports: list, module: _Module, directory_index: dict = None
+) -> list:
     """
     Match a module's imports to modules in the same directory.
 
     Args:
         imports (list): The list of modules imported by another module.
         module (_Module): The importing module.
+        directory_index (dict): The index of module files, from
+            :py:func:`_build_directory_index`. If this is ``None``, check the file system for
+            each import instead.
 
     Returns:
         list: The list of ``imports``, with sibling modules updated with full names.
     """
     module_directory = os.path.dirname(module.path)
+    if directory_index is None:
+        return [
+            (
+                ".".join(module.packages) + "." + imported_module
+                if os.path.exists(
+                    os.path.join(module_directory, f"{imported_module}.py")
+                )
+                else imported_module
+            )
+            for imported_module in imports
+        ]
+    siblings = directory_index.get(module_directory, ())
     return [
-        ".".join(module.packages) + "." + imported_module
-        if os.path.exists(os.path.join(module_directory, f"{imported_module}.py"))
-        else imported_module
+        (
+            ".".join(module.packages) + "." + imported_module
+            if imported_module in siblings
+            else imported_module
+        )
         for imported_module in imports
     ]
 
 
-def _filter_imports(imports: list, modules: list) -> None:
-    local_imports = list({i for i in imports if i in modules})
-    return local_imports
+def _filter_imports(imports: list, modules: _ModuleRegistry, lines: list) -> tuple:
+    """
+    Find the imports that are modules in the project.
+
+    Args:
+        imports (list): The full names of the imported modules.
+        modules (_ModuleRegistry): The modules in the project.
+        lines (list): The line number of each import, in the same order as ``imports``.
+
+    Returns:
+        tuple: The IDs of the imported project modules, without duplicates, in the order they
+        are first imported, and the line of the first import of each, as two arrays.
+    """
+    first_lines = {}
+    for name, line in zip(imports, lines):
+        module = modules.get(name)
+        if module is not None:
+            first_lines.setdefault(module.id, line)
+    return array.array("i", first_lines), array.array("i", first_lines.values())
 
 
-def _write_component_diagram(modules: list, plantuml_file) -> None:
+def _write_component_diagram(
+    graph: _DependencyGraph, plantuml_file, cycles: list = (), stubs=()
+) -> None:
     """
     Write the PlantUML file.
 
     Args:
-        modules (list): The list of Python modules to include in the diagram.
+        graph (_DependencyGraph): The graph of the Python modules to include in the diagram.
         plantuml_file: The destination stream for the PlantUML code. This should be an open file
             stream, or a system stream such as ``sys.stdout``.
+        cycles (list): The import cycles to highlight, from :py:func:`_find_cycles`. Edges
+            between two modules in the same cycle are drawn in red.
+        stubs: The nodes that belong to another shard, from :py:func:`_shard_by_package`.
+            They are drawn with the ``stub`` stereotype.
     """
     plantuml_file.writelines(["@startuml\n", "skinparam linetype ortho\n"])
-    _write_module_to_diagram(modules, plantuml_file)
-    _write_dependencies_to_diagram(modules, plantuml_file)
+    if stubs:
+        plantuml_file.write(
+            "skinparam componentBackgroundColor<<stub>> White\n"
+            "skinparam componentBorderColor<<stub>> Gray\n"
+        )
+    _write_module_to_diagram(graph.modules, plantuml_file, stubs)
+    _write_dependencies_to_diagram(graph, plantuml_file, cycles)
     plantuml_file.write("@enduml")
 
 
-def _write_module_to_diagram(modules: list, plantuml_file) -> None:
-    for module in modules:
-        for i, package in enumerate(module.packages):
-            plantuml_file.write(
-                f"frame {package} as {'.'.join(module.packages[:i+1])} {{\n"
+class _ChunkedWriter:
+    """
+    A text stream that collects small writes and passes them on in large chunks.
+
+    The diagram writers make one call per line. Joining the lines in blocks turns hundreds of
+    thousands of writes to a line-buffered stream, such as a terminal, into a few dozen. Use
+    the writer in a ``with`` statement, or call :py:meth:`flush` when you are done.
+    """
+
+    def __init__(self, stream, chunk_size: int = 1 << 16, digest=None) -> None:
+        """
+        Args:
+            stream: The stream to write the chunks to.
+            chunk_size (int): The number of characters to collect before writing them.
+            digest: A :py:mod:`hashlib` object to update with the UTF-8 encoding of every
+                chunk, or ``None``.
+        """
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._digest = digest
+        self._parts = []
+        self._size = 0
+
+    def write(self, text: str) -> int:
+        if len(text) >= self._chunk_size:
+            self.flush()
+            self._write_chunk(text)
+            return len(text)
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self._chunk_size:
+            self.flush()
+        return len(text)
+
+    def writelines(self, lines) -> None:
+        for line in lines:
+            self.write(line)
+
+    def flush(self) -> None:
+        """Write the collected text to the stream."""
+        if self._parts:
+            self._write_chunk("".join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def _write_chunk(self, text: str) -> None:
+        if self._digest is not None:
+            self._digest.update(text.encode())
+        self._stream.write(text)
+
+    def __enter__(self) -> "_ChunkedWriter":
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.flush()
+
+
+def _write_dot_diagram(
+    graph: _DependencyGraph, dot_file, cycles: list = (), stubs=()
+) -> None:
+    """
+    Write the diagram as a Graphviz DOT graph.
+
+    Packages become nested clusters, and each module is a node named by its full name.
+
+    Args:
+        graph (_DependencyGraph): The graph of the Python modules to include in the diagram.
+        dot_file: The destination stream for the DOT code.
+        cycles (list): The import cycles to highlight, from :py:func:`_find_cycles`. Edges
+            between two modules in the same cycle are drawn in red.
+        stubs: The nodes that belong to another shard, from :py:func:`_shard_by_package`.
+            They are drawn dashed.
+    """
+    dot_file.write(
+        "digraph components {\n"
+        "node [shape=component, fontname=Helvetica];\n"
+        "edge [arrowsize=0.7];\n"
+    )
+    _write_dot_cluster(_package_tree(graph.modules), graph.modules, dot_file, stubs)
+    modules = graph.modules
+    cycle_of = {node: i for i, cycle in enumerate(cycles) for node in cycle}
+    for position, (source, target) in enumerate(graph.edges()):
+        cycle = cycle_of.get(source)
+        attributes = []
+        if cycle is not None and cycle == cycle_of.get(target):
+            attributes.append("color=red")
+        if graph.weights is not None:
+            attributes.append(f'label="{graph.weights[position]}"')
+        attributes = f" [{', '.join(attributes)}]" if attributes else ""
+        dot_file.write(
+            f"{_dot_id(modules[source].full_name)} -> "
+            f"{_dot_id(modules[target].full_name)}{attributes};\n"
+        )
+    dot_file.write("}\n")
+
+
+def _write_dot_cluster(
+    package: "_PackageTree", modules: list, dot_file, stubs=()
+) -> None:
+    for node in package.nodes:
+        style = ", style=dashed" if node in stubs else ""
+        dot_file.write(
+            f"{_dot_id(modules[node].full_name)} "
+            f"[label={_dot_id(modules[node].name)}{style}];\n"
+        )
+    for child in package.children.values():
+        dot_file.write(
+            f"subgraph {_dot_id('cluster_' + child.full_name)} {{\n"
+            f"label={_dot_id(child.name)};\n"
+        )
+        _write_dot_cluster(child, modules, dot_file, stubs)
+        dot_file.write("}\n")
+
+
+def _dot_id(name: str) -> str:
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class _PackageTree:
+    """
+    A package and the modules and packages in it.
+
+    Attributes:
+        name (str): The name of the package, or an empty string for the root of the tree.
+        full_name (str): The full name of the package.
+        children (dict): The subpackages, by name, in the order they are first found.
+        nodes (list): The graph nodes of the modules directly in the package.
+    """
+
+    __slots__ = ("name", "full_name", "children", "nodes")
+
+    def __init__(self, name: str, full_name: str) -> None:
+        self.name = name
+        self.full_name = full_name
+        self.children = {}
+        self.nodes = []
+
+
+def _package_tree(modules: list) -> _PackageTree:
+    """
+    Arrange modules by package.
+
+    Args:
+        modules (list): The modules, indexed by graph node.
+
+    Returns:
+        _PackageTree: The root of the tree, which holds the modules outside any package.
+    """
+    root = _PackageTree("", "")
+    for node, module in enumerate(modules):
+        package = root
+        for i, name in enumerate(module.packages):
+            child = package.children.get(name)
+            if child is None:
+                child = _PackageTree(name, ".".join(module.packages[: i + 1]))
+                package.children[name] = child
+            package = child
+        package.nodes.append(node)
+    return root
+
+
+def _write_module_to_diagram(modules: list, plantuml_file, stubs=()) -> None:
+    _write_package_to_diagram(
+        _package_tree(modules), modules, plantuml_file.write, stubs
+    )
+
+
+def _write_package_to_diagram(
+    package: "_PackageTree", modules: list, write, stubs=()
+) -> None:
+    for node in package.nodes:
+        module = modules[node]
+        stereotype = " <<stub>>" if node in stubs else ""
+        write(f"[{module.name}] as {module.full_name}{stereotype}\n")
+    for child in package.children.values():
+        write(f"frame {child.name} as {child.full_name} {{\n")
+        _write_package_to_diagram(child, modules, write, stubs)
+        write("}\n")
+
+
+def _write_dependencies_to_diagram(
+    graph: _DependencyGraph, plantuml_file, cycles: list = ()
+) -> None:
+    names = [f"[{module.full_name}]" for module in graph.modules]
+    cycle_of = {node: i for i, cycle in enumerate(cycles) for node in cycle}
+    offsets = graph.offsets
+    targets = graph.targets
+    weights = graph.weights
+    write = plantuml_file.write
+    for source in range(len(names)):
+        cycle = cycle_of.get(source)
+        source_name = names[source]
+        for position in range(offsets[source], offsets[source + 1]):
+            target = targets[position]
+            if cycle is not None and cycle == cycle_of.get(target):
+                arrow = " -[#red]-> "
+            else:
+                arrow = " --> "
+            if weights is None:
+                write(source_name + arrow + names[target] + "\n")
+            else:
+                write(f"{source_name}{arrow}{names[target]} : {weights[position]}\n")
+
+
+def _write_json(
+    graph: _DependencyGraph, json_file, cycles: list = (), stubs=()
+) -> None:
+    """
+    Write the graph as one JSON document.
+
+    The document is an object with these keys:
+
+    - ``modules``: An object for each module, with its ``name``, ``path`` and ``packages``.
+      Modules from another shard also have ``"stub": true``.
+    - ``edges``: An object for each dependency, with the ``source`` and ``target`` indices in
+      ``modules`` and the ``line`` of the first import, or ``null`` if it is not known. With
+      --collapse-depth, each edge also has a ``weight``.
+    - ``packages``: The full names of the packages that contain the modules.
+    - ``cycles``: The lists of indices in ``modules`` for each highlighted import cycle.
+
+    Args:
+        graph (_DependencyGraph): The graph of the Python modules to include.
+        json_file: The destination stream for the JSON.
+        cycles (list): The import cycles to include, from :py:func:`_find_cycles`.
+        stubs: The nodes that belong to another shard, from :py:func:`_shard_by_package`.
+    """
+    modules = graph.modules
+    document = {
+        "modules": [
+            _module_record(module, node in stubs) for node, module in enumerate(modules)
+        ],
+        "edges": [
+            _edge_record(source, target, line, weight)
+            for source, target, line, weight in _edges_with_lines(graph)
+        ],
+        "packages": list(
+            dict.fromkeys(
+                ".".join(module.packages[: i + 1])
+                for module in modules
+                for i in range(len(module.packages))
+            )
+        ),
+        "cycles": [list(cycle) for cycle in cycles],
+    }
+    # dumps() uses the C encoder, which is much faster than dump() and its many small writes.
+    json_file.write(json.dumps(document) + "\n")
+
+
+def _write_json_lines(
+    graph: _DependencyGraph, json_file, cycles: list = (), stubs=()
+) -> None:
+    """
+    Write the graph as JSON Lines, with one record per module.
+
+    Each record has the module's ``name``, ``path`` and ``packages``, and an ``imports``
+    list with the ``module`` name and ``line`` of each dependency, and its ``weight`` with
+    --collapse-depth. Modules in a highlighted import cycle also have a ``cycle`` number, and
+    modules from another shard have ``"stub": true``. The records are written one at a time,
+    so the whole graph is never held as one document.
+
+    Args:
+        graph (_DependencyGraph): The graph of the Python modules to include.
+        json_file: The destination stream for the records.
+        cycles (list): The import cycles to include, from :py:func:`_find_cycles`.
+        stubs: The nodes that belong to another shard, from :py:func:`_shard_by_package`.
+    """
+    modules = graph.modules
+    cycle_of = {node: i for i, cycle in enumerate(cycles) for node in cycle}
+    for node, module in enumerate(modules):
+        record = _module_record(module, node in stubs)
+        record["imports"] = [
+            _edge_record(None, modules[target].full_name, line, weight)
+            for _, target, line, weight in _edges_with_lines(graph, node)
+        ]
+        if node in cycle_of:
+            record["cycle"] = cycle_of[node]
+        json_file.write(json.dumps(record) + "\n")
+
+
+def _module_record(module: _Module, stub: bool = False) -> dict:
+    record = {
+        "name": module.full_name,
+        "path": module.path,
+        "packages": list(module.packages),
+    }
+    if stub:
+        record["stub"] = True
+    return record
+
+
+def _edge_record(source, target, line: int, weight: int) -> dict:
+    record = (
+        {"module": target} if source is None else {"source": source, "target": target}
+    )
+    record["line"] = line
+    if weight is not None:
+        record["weight"] = weight
+    return record
+
+
+def _edges_with_lines(graph: _DependencyGraph, node: int = None):
+    """
+    Generate each edge of a graph as a ``(source, target, line, weight)`` tuple.
+
+    The line of the import and the weight are ``None`` if they are not known. If ``node``
+    is given, only its edges are generated.
+    """
+    nodes = range(len(graph)) if node is None else (node,)
+    for node in nodes:
+        module = graph.modules[node]
+        lines = dict(zip(module.dependencies, module.lines))
+        for position in range(graph.offsets[node], graph.offsets[node + 1]):
+            target = graph.targets[position]
+            yield node, target, lines.get(graph.modules[target].id), (
+                None if graph.weights is None else graph.weights[position]
             )
-        plantuml_file.write(f"[{module.name}] as {module.full_name}\n")
-        for package in module.packages:
-            plantuml_file.write("}\n")
 
 
-def _write_dependencies_to_diagram(modules: list, plantuml_file) -> None:
-    for module in modules:
-        for d in module.dependencies:
-            plantuml_file.write(f"[{module.full_name}] --> [{d}]\n")
+_WRITERS = {
+    "dot": _write_dot_diagram,
+    "json": _write_json,
+    "jsonl": _write_json_lines,
+    "plantuml": _write_component_diagram,
+}
 
 
 def _include_module(module: _Module) -> None:
@@ -205,5 +2885,181 @@ def _run_plantuml(plantuml_file: str, image_type: str) -> None:
     )
 
 
+def _make_renderer(arguments: argparse.Namespace):
+    """
+    Create the image renderer selected on the command line.
+
+    Args:
+        arguments (argparse.Namespace): The command line arguments.
+
+    Returns:
+        The renderer. Call its ``close()`` method when you are done with it.
+    """
+    if arguments.format == "dot":
+        return _DotRenderer()
+    if arguments.renderer == "pipe" or (
+        arguments.renderer == "auto" and (arguments.watch or arguments.batch)
+    ):
+        return _PipeRenderer()
+    return _OneShotRenderer()
+
+
+class _OneShotRenderer:
+    """Render each image with a new PlantUML process."""
+
+    # Whether several threads may render at once.
+    thread_safe = True
+
+    def render(self, plantuml_file: str, image_type: str) -> None:
+        """
+        Render an image of a diagram.
+
+        Args:
+            plantuml_file (str): The path to the PlantUML file. The image is written next to
+                it.
+            image_type (str): The type of image for PlantUML to generate.
+        """
+        _run_plantuml(plantuml_file, image_type)
+
+    def image_path(self, plantuml_file: str, image_type: str) -> str:
+        return _image_path(plantuml_file, image_type)
+
+    def close(self) -> None:
+        pass
+
+
+class _DotRenderer:
+    """Render each image by piping the DOT file to the Graphviz ``dot`` program."""
+
+    thread_safe = True
+
+    def render(self, dot_file: str, image_type: str) -> None:
+        """
+        Render an image of a diagram.
+
+        Args:
+            dot_file (str): The path to the DOT file. The image is written next to it.
+            image_type (str): The Graphviz output format.
+        """
+        with open(dot_file, "rb") as f:
+            subprocess.run(
+                [
+                    "dot",
+                    "-T" + image_type,
+                    "-o",
+                    self.image_path(dot_file, image_type),
+                ],
+                stdin=f,
+                check=True,
+            )
+
+    def image_path(self, dot_file: str, image_type: str) -> str:
+        return os.path.splitext(dot_file)[0] + "." + image_type.split(":")[0]
+
+    def close(self) -> None:
+        pass
+
+
+class _PipeRenderer:
+    """
+    Render images with long-running PlantUML processes.
+
+    Each image type gets one PlantUML process in ``-pipe`` mode. The renderer writes the
+    diagram to the process's standard input and reads the image from its standard output, up
+    to a delimiter that PlantUML writes after each image.
+    """
+
+    _DELIMITER = b"___COMPONENTS_END_OF_IMAGE___"
+
+    # Each image type has its own process, which can render one image at a time.
+    thread_safe = False
+
+    def __init__(self) -> None:
+        self._processes = {}
+        self._buffers = {}
+
+    def render(self, plantuml_file: str, image_type: str) -> None:
+        """
+        Render an image of a diagram.
+
+        Args:
+            plantuml_file (str): The path to the PlantUML file. The image is written next to
+                it, with the name PlantUML would use.
+            image_type (str): The type of image for PlantUML to generate.
+
+        Raises:
+            subprocess.CalledProcessError: If PlantUML exits before writing the image.
+        """
+        with open(plantuml_file, "rb") as f:
+            diagram = f.read()
+        process = self._processes.get(image_type)
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(
+                [
+                    "plantuml",
+                    "-pipe",
+                    "-t" + image_type,
+                    "-pipedelimitor",
+                    self._DELIMITER.decode(),
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            self._processes[image_type] = process
+            self._buffers.pop(image_type, None)
+        try:
+            process.stdin.write(diagram.rstrip() + b"\n")
+            process.stdin.flush()
+            image = self._read_image(image_type)
+        except BrokenPipeError:
+            image = None
+        if image is None:
+            del self._processes[image_type]
+            raise subprocess.CalledProcessError(process.wait(), process.args)
+        with open(_image_path(plantuml_file, image_type), "wb") as f:
+            f.write(image)
+
+    def image_path(self, plantuml_file: str, image_type: str) -> str:
+        return _image_path(plantuml_file, image_type)
+
+    def close(self) -> None:
+        """Stop the PlantUML processes."""
+        for process in self._processes.values():
+            process.stdin.close()
+            process.wait()
+        self._processes = {}
+        self._buffers = {}
+
+    def _read_image(self, image_type: str):
+        """
+        Read one image from a PlantUML process.
+
+        Returns:
+            bytes: The image, or ``None`` if the process exited first.
+        """
+        data = self._buffers.pop(image_type, bytearray())
+        start = 0
+        while True:
+            end = data.find(self._DELIMITER, start)
+            if end != -1:
+                break
+            start = max(0, len(data) - len(self._DELIMITER) + 1)
+            chunk = self._processes[image_type].stdout.read1(65536)
+            if not chunk:
+                return None
+            data += chunk
+        self._buffers[image_type] = data[end + len(self._DELIMITER) :]
+        # PlantUML ends the delimiter with a newline, which may arrive with the next image.
+        return bytes(data[:end]).lstrip(b"\r\n")
+
+
+def _image_path(plantuml_file: str, image_type: str) -> str:
+    """Get the path of the image PlantUML writes for a diagram file."""
+    extension = {"txt": "atxt", "latex": "tex", "latex:nopreamble": "tex"}.get(
+        image_type, image_type
+    )
+    return os.path.splitext(plantuml_file)[0] + "." + extension
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,746 @@
+"""Unit tests for the component diagram generator."""
+
+import array
+import itertools
+import os.path
+import random
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+import components
+
+
+class GetImportsTest(unittest.TestCase):
+    def setUp(self):
+        self.module = components._Module("a.b.c", "/project/a/b/c.py")
+        self.index = {"/project/a/b": {"c", "d", "e"}, "/project/a": {"d"}}
+
+    def resolve(self, *imports):
+        return components._get_imports(
+            self.module,
+            [components._Import(*i, line=1) for i in imports],
+            self.index,
+        )
+
+    def test_absolute_import(self):
+        self.assertEqual(self.resolve(("os", (), 0)), ["os"])
+
+    def test_sibling_import(self):
+        self.assertEqual(self.resolve(("d", (), 0)), ["a.b.d"])
+
+    def test_relative_import_from_package(self):
+        self.assertEqual(self.resolve(("e", ("name",), 1)), ["a.b.e"])
+
+    def test_relative_import_of_names(self):
+        self.assertEqual(self.resolve(("", ("d", "e"), 1)), ["a.b.d", "a.b.e"])
+
+    def test_relative_import_from_parent_package(self):
+        self.assertEqual(self.resolve(("d", ("x",), 2)), ["a.d"])
+        self.assertEqual(self.resolve(("", ("d",), 2)), ["a.d"])
+
+    def test_relative_import_above_project(self):
+        self.assertEqual(self.resolve(("d", ("x",), 4)), [])
+
+    def test_lines(self):
+        lines = []
+        components._get_imports(
+            self.module,
+            [
+                components._Import("os", (), 0, 3),
+                components._Import("", ("d", "e"), 1, 5),
+            ],
+            self.index,
+            lines,
+        )
+        self.assertEqual(lines, [3, 5, 5])
+
+
+class ExtractImportsWithTokenizeTest(unittest.TestCase):
+    SOURCE = (
+        b'"""Docstring."""\n'
+        b"import os, sys as system\n"
+        b"from . import (a,\n"
+        b"    b)\n"
+        b"from ..c.d import e  # comment\n"
+        b"try:\n"
+        b"    import f\n"
+        b"except ImportError:\n"
+        b"    f = None\n"
+        b"\n"
+        b"def function():\n"
+        b"    import g\n"
+    )
+
+    def extract(self, source, full_scan=False):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "module.py")
+            with open(path, "wb") as f:
+                f.write(source)
+            return components._extract_imports_with_tokenize(path, full_scan)
+
+    def test_imports_before_first_definition(self):
+        self.assertEqual(
+            self.extract(self.SOURCE),
+            [
+                components._Import("os", (), 0, 2),
+                components._Import("sys", (), 0, 2),
+                components._Import("", ("a", "b"), 1, 3),
+                components._Import("c.d", ("e",), 2, 5),
+                components._Import("f", (), 0, 7),
+            ],
+        )
+
+    def test_full_scan_matches_ast(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "module.py")
+            with open(path, "wb") as f:
+                f.write(self.SOURCE)
+            self.assertEqual(
+                components._extract_imports_with_tokenize(path, full_scan=True),
+                components._extract_imports_with_ast(path),
+            )
+
+    def test_invalid_encoding_falls_back_to_regex(self):
+        imports = self.extract(b'import a\nx = "\xe9"\n', full_scan=True)
+        self.assertEqual([i.module for i in imports], ["a"])
+
+
+class GetPythonFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name + "/"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, *paths, content=""):
+        for path in paths:
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+
+    def find(self, **kwargs):
+        return [
+            f.path[len(self.root) :]
+            for f in components._get_python_files(self.root, **kwargs)
+        ]
+
+    def test_build_packages_are_kept(self):
+        self.write(
+            "build/lib/package/module.py",
+            "dist/module.py",
+            "package/build/__init__.py",
+            "package/build/module.py",
+        )
+        self.assertEqual(
+            self.find(), ["package/build/__init__.py", "package/build/module.py"]
+        )
+
+    def test_symbolic_links_to_directories(self):
+        self.write("package/module.py")
+        with tempfile.TemporaryDirectory() as external:
+            os.mkdir(os.path.join(external, "library"))
+            open(os.path.join(external, "library", "module.py"), "w").close()
+            os.symlink(external, self.root + "linked")
+            os.symlink("..", self.root + "package/loop")
+            self.assertEqual(
+                self.find(), ["linked/library/module.py", "package/module.py"]
+            )
+
+    def test_excluded_directories(self):
+        self.write(
+            "a.py",
+            ".hidden/b.py",
+            "__pycache__/c.py",
+            "project.egg-info/d.py",
+            "environment/pyvenv.cfg",
+            "environment/e.py",
+        )
+        self.assertEqual(self.find(), ["a.py"])
+
+    def test_excludes(self):
+        self.write("a.py", "tests/b.py", "package/test_c.py")
+        self.assertEqual(self.find(excludes=["tests", "*/test_*.py"]), ["a.py"])
+
+    def test_gitignore(self):
+        self.write("package/.gitignore", content="generated_*.py\n!generated_keep.py\n")
+        self.write(".gitignore", content="/output/\nscratch*\n")
+        self.write(
+            "package/generated_a.py",
+            "package/generated_keep.py",
+            "output/a.py",
+            "package/output/b.py",
+            "package/scratch.py",
+            "scratch/c.py",
+        )
+        self.assertEqual(
+            self.find(), ["package/generated_keep.py", "package/output/b.py"]
+        )
+        self.assertEqual(len(self.find(use_gitignore=False)), 6)
+
+
+class GitignoreTest(unittest.TestCase):
+    def rules(self, text, directory=""):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, ".gitignore")
+            with open(path, "w") as f:
+                f.write(text)
+            return components._read_gitignore(path, directory)
+
+    def assertIgnored(self, rules, *paths, ignored=True):
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(components._is_ignored(path, rules), ignored)
+
+    def test_unanchored_pattern(self):
+        rules = self.rules("*.py\n")
+        self.assertIgnored(rules, "a.py", "a/b.py", "a/b.py/")
+        self.assertIgnored(rules, "a.pyc", "py/", ignored=False)
+
+    def test_anchored_pattern(self):
+        rules = self.rules("/a/b\n")
+        self.assertIgnored(rules, "a/b", "a/b/")
+        self.assertIgnored(rules, "c/a/b", ignored=False)
+
+    def test_directory_pattern(self):
+        rules = self.rules("build/\n")
+        self.assertIgnored(rules, "build/", "a/build/")
+        self.assertIgnored(rules, "build", ignored=False)
+
+    def test_nested_file(self):
+        rules = self.rules("*.py\n", "a/")
+        self.assertIgnored(rules, "a/b.py", "a/b/c.py")
+        self.assertIgnored(rules, "b.py", ignored=False)
+
+    def test_negation(self):
+        rules = self.rules("*.py\n!keep.py\n")
+        self.assertIgnored(rules, "a.py")
+        self.assertIgnored(rules, "keep.py", "a/keep.py", ignored=False)
+
+    def test_comments_and_escapes(self):
+        rules = self.rules("# comment\n\\#name\n")
+        self.assertIgnored(rules, "#name")
+        self.assertIgnored(rules, "# comment", ignored=False)
+
+    def test_translate_glob(self):
+        for pattern, path, matches in (
+            ("a?c", "abc", True),
+            ("a?c", "a/c", False),
+            ("a*", "abc", True),
+            ("a*", "a/b", False),
+            ("a/**/b", "a/b", True),
+            ("a/**/b", "a/x/y/b", True),
+            ("a**", "a/b/c", True),
+            ("[ab]c", "bc", True),
+            ("[!ab]c", "bc", False),
+            ("[!ab]c", "cc", True),
+            ("a.b", "axb", False),
+        ):
+            with self.subTest(pattern=pattern, path=path):
+                expression = components._translate_glob(pattern) + r"\Z"
+                self.assertEqual(bool(re.match(expression, path)), matches)
+
+
+class ImportCacheTest(unittest.TestCase):
+    IMPORTS = [components._Import("os", (), 0, 1)]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.directory.name, "cache")
+        self.path = os.path.join(self.directory.name, "module.py")
+        self.cache = components._ImportCache(self.cache_dir)
+        self.write("import os\n")
+        self.store()
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def write(self, content, mtime_ns=None):
+        with open(self.path, "w") as f:
+            f.write(content)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def store(self, extractor="ast"):
+        self.cache.store(
+            self.path,
+            os.stat(self.path),
+            extractor,
+            components._file_digest(self.path),
+            self.IMPORTS,
+        )
+
+    def lookup(self, extractor="ast"):
+        return self.cache.lookup(self.path, os.stat(self.path), extractor)
+
+    def test_hit(self):
+        self.assertEqual(self.lookup(), self.IMPORTS)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_size_change_is_a_miss(self):
+        self.write("import sys\n", mtime_ns=os.stat(self.path).st_mtime_ns)
+        self.assertIsNone(self.lookup())
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    def test_same_size_change_is_a_miss(self):
+        self.write("import re\n", mtime_ns=10**18)
+        self.assertIsNone(self.lookup())
+
+    def test_touched_file_is_a_hit_and_refreshes_the_mtime(self):
+        self.write("import os\n", mtime_ns=10**18)
+        self.assertEqual(self.lookup(), self.IMPORTS)
+        with mock.patch.object(components, "_file_digest") as file_digest:
+            self.assertEqual(self.lookup(), self.IMPORTS)
+        file_digest.assert_not_called()
+
+    def test_entries_are_kept_per_extractor(self):
+        self.assertIsNone(self.lookup("tokenize"))
+        self.store("tokenize")
+        self.assertEqual(self.lookup("tokenize"), self.IMPORTS)
+        self.assertEqual(self.lookup("ast"), self.IMPORTS)
+
+    def test_prune_removes_deleted_paths(self):
+        self.cache.prune(self.directory.name + "/", [])
+        self.assertIsNone(self.lookup())
+
+    def test_prune_keeps_existing_and_outside_paths(self):
+        self.cache.prune(self.directory.name + "/", [self.path])
+        self.cache.prune("/elsewhere/", [])
+        self.assertEqual(self.lookup(), self.IMPORTS)
+
+    def test_version_change_drops_the_entries(self):
+        self.cache.close()
+        with mock.patch.object(components._ImportCache, "_VERSION", 0):
+            components._ImportCache(self.cache_dir).close()
+        self.cache = components._ImportCache(self.cache_dir)
+        self.assertIsNone(self.lookup())
+
+    def test_entries_persist(self):
+        self.cache.close()
+        self.cache = components._ImportCache(self.cache_dir)
+        self.assertEqual(self.lookup(), self.IMPORTS)
+
+
+class FindNodesTest(unittest.TestCase):
+    def test_names_and_paths(self):
+        with tempfile.TemporaryDirectory() as directory:
+            root = directory + "/"
+            os.mkdir(root + "email")
+            for name in ("message", "utils"):
+                open(f"{root}email/{name}.py", "w").close()
+            modules = [
+                components._Module(name, "")
+                for name in ("app", "email.message", "email.utils")
+            ]
+            registry = components._ModuleRegistry(modules)
+            graph = components._DependencyGraph(
+                modules[1:], array.array("i"), array.array("i")
+            )
+            for names, nodes in (
+                (["email.message"], [0]),
+                (["email/message.py"], [0]),
+                ([root + "email/utils.py"], [1]),
+                (["email"], [0, 1]),
+            ):
+                with self.subTest(names=names):
+                    found = components._find_nodes(graph, registry, names, root)
+                    self.assertEqual(sorted(found), nodes)
+            with self.assertRaises(SystemExit):
+                components._find_nodes(graph, registry, ["app"], root)
+
+
+class ProjectUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name + "/"
+        # Put the modules in a package, so that their sibling imports get full names.
+        self.package = self.root + "p/"
+        os.mkdir(self.package)
+        self.write("a.py", "import b\nimport d\n")
+        self.write("b.py", "import c\n")
+        self.write("c.py", "")
+        arguments = components._parse_command_line(["--jobs", "1", self.root])
+        self.project = components._Project(arguments)
+        self.project.scan()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        with open(self.package + name, "w") as f:
+            f.write(content)
+
+    def edges(self):
+        graph = self.project.graph()
+        return {
+            (graph.modules[source].name, graph.modules[target].name)
+            for source, target in graph.edges()
+        }
+
+    def update(self, *names):
+        with mock.patch.object(
+            components, "_extract_all_imports", wraps=components._extract_all_imports
+        ) as extract:
+            changed = self.project.update({self.package + name for name in names})
+        self.extracted = [
+            path[len(self.package) :]
+            for call in extract.call_args_list
+            for path in call[0][0]
+        ]
+        return changed
+
+    def test_scan(self):
+        self.assertEqual(self.edges(), {("a", "b"), ("b", "c")})
+
+    def test_changed_import(self):
+        self.write("b.py", "import a\n")
+        self.assertTrue(self.update("b.py"))
+        self.assertEqual(self.extracted, ["b.py"])
+        self.assertEqual(self.edges(), {("a", "b"), ("b", "a")})
+
+    def test_moved_import(self):
+        self.write("b.py", "\nimport c\n")
+        self.assertTrue(self.update("b.py"))
+
+    def test_whitespace_change(self):
+        self.write("b.py", "import c  \n\n")
+        self.assertFalse(self.update("b.py"))
+        self.assertEqual(self.extracted, ["b.py"])
+
+    def test_no_change(self):
+        self.assertFalse(self.update())
+        self.assertEqual(self.extracted, [])
+
+    def test_added_file(self):
+        self.write("d.py", "import c\n")
+        self.assertTrue(self.update())
+        # a.py is not read again, but its import of d is resolved again.
+        self.assertEqual(self.extracted, ["d.py"])
+        self.assertEqual(self.edges(), {("a", "b"), ("a", "d"), ("b", "c"), ("d", "c")})
+
+    def test_removed_file(self):
+        os.remove(self.package + "c.py")
+        self.assertTrue(self.update())
+        self.assertEqual(self.extracted, [])
+        self.assertEqual(self.edges(), {("a", "b")})
+        self.assertNotIn("p.c", self.project.registry)
+
+
+def _graph(nodes, edges, weights=None):
+    """Build a graph of modules named ``m0``, ``m1``..., or of the modules named in a list."""
+    if isinstance(nodes, int):
+        nodes = [f"m{i}" for i in range(nodes)]
+    return components._DependencyGraph(
+        [components._Module(name, "") for name in nodes],
+        array.array("i", [source for source, _ in edges]),
+        array.array("i", [target for _, target in edges]),
+        None if weights is None else array.array("i", weights),
+    )
+
+
+def _weights(graph):
+    return dict(zip(graph.edges(), graph.weights))
+
+
+def _random_graphs(count=100, max_nodes=12):
+    generator = random.Random(0)
+    for _ in range(count):
+        node_count = generator.randint(1, max_nodes)
+        edges = [
+            (source, target)
+            for source, target in itertools.product(range(node_count), repeat=2)
+            if generator.random() < 0.2
+        ]
+        yield _graph(node_count, edges)
+
+
+def _reachable(graph):
+    """Find the nodes reachable from each node by brute force."""
+    reachable = [set(graph.successors(node)) for node in range(len(graph))]
+    changed = True
+    while changed:
+        changed = False
+        for nodes in reachable:
+            found = set().union(*(reachable[node] for node in nodes)) - nodes
+            if found:
+                nodes |= found
+                changed = True
+    return reachable
+
+
+class StronglyConnectedComponentsTest(unittest.TestCase):
+    def test_cycles(self):
+        graph = _graph(6, [(0, 1), (1, 2), (2, 0), (2, 3), (3, 3), (4, 5), (5, 4)])
+        self.assertEqual(components._find_cycles(graph), [[0, 1, 2], [4, 5]])
+
+    def test_deep_chain(self):
+        node_count = 100000
+        graph = _graph(node_count, [(i, i + 1) for i in range(node_count - 1)])
+        components_ = components._strongly_connected_components(graph)
+        self.assertEqual(len(components_), node_count)
+        self.assertEqual(components_[0], [node_count - 1])
+
+    def test_random_graphs(self):
+        for graph in _random_graphs():
+            reachable = _reachable(graph)
+            components_ = components._strongly_connected_components(graph)
+            self.assertEqual(
+                sorted(node for component in components_ for node in component),
+                list(range(len(graph))),
+            )
+            component_of = {
+                node: i for i, component in enumerate(components_) for node in component
+            }
+            for a, b in itertools.product(range(len(graph)), repeat=2):
+                same = a == b or (b in reachable[a] and a in reachable[b])
+                self.assertEqual(component_of[a] == component_of[b], same)
+                # Reverse topological order: dependencies come first.
+                if b in reachable[a] and not same:
+                    self.assertGreater(component_of[a], component_of[b])
+
+
+class TransitiveReductionTest(unittest.TestCase):
+    def test_implied_edge(self):
+        graph = _graph(3, [(0, 1), (1, 2), (0, 2)])
+        reduced = components._transitive_reduction(graph)
+        self.assertEqual(list(reduced.edges()), [(0, 1), (1, 2)])
+
+    def test_cycle_edges_are_kept(self):
+        graph = _graph(4, [(0, 1), (1, 0), (1, 2), (0, 2), (2, 3)])
+        reduced = components._transitive_reduction(graph)
+        # Of the two edges from the cycle to 2, only the first is kept.
+        self.assertEqual(list(reduced.edges()), [(0, 1), (0, 2), (1, 0), (2, 3)])
+
+    def test_weights_follow_kept_edges(self):
+        graph = components._DependencyGraph(
+            [components._Module(f"m{i}", "") for i in range(3)],
+            array.array("i", [0, 0, 1]),
+            array.array("i", [2, 1, 2]),
+            array.array("i", [5, 6, 7]),
+        )
+        reduced = components._transitive_reduction(graph)
+        self.assertEqual(list(reduced.edges()), [(0, 1), (1, 2)])
+        self.assertEqual(list(reduced.weights), [6, 7])
+
+    def test_random_graphs(self):
+        for graph in _random_graphs():
+            reduced = components._transitive_reduction(graph)
+            self.assertEqual(_reachable(reduced), _reachable(graph))
+            edges = set(graph.edges())
+            self.assertLessEqual(set(reduced.edges()), edges)
+            # No kept edge between components is implied by another path.
+            component_of = {
+                node: i
+                for i, component in enumerate(
+                    components._strongly_connected_components(graph)
+                )
+                for node in component
+            }
+            for source, target in reduced.edges():
+                if component_of[source] == component_of[target]:
+                    continue
+                without = _graph(
+                    len(graph), [e for e in reduced.edges() if e != (source, target)]
+                )
+                self.assertNotIn(target, _reachable(without)[source])
+
+
+class WriteDiagramTest(unittest.TestCase):
+    def write(self, path):
+        def writer(graph, stream, cycles, stubs):
+            stream.write("diagram\n")
+
+        return components._write_diagram(writer, None, [], (), path, None)
+
+    def test_symbolic_link_is_followed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            target = os.path.join(directory, "target.puml")
+            link = os.path.join(directory, "link.puml")
+            with open(target, "w") as f:
+                f.write("old\n")
+            os.chmod(target, 0o640)
+            os.symlink("target.puml", link)
+            self.write(link)
+            self.assertTrue(os.path.islink(link))
+            with open(target) as f:
+                self.assertEqual(f.read(), "diagram\n")
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0o640)
+            self.assertEqual(
+                sorted(os.listdir(directory)), ["link.puml", "target.puml"]
+            )
+
+
+class SubgraphTest(unittest.TestCase):
+    def test_induced_edges(self):
+        graph = _graph(4, [(0, 1), (1, 2), (0, 2), (2, 0), (3, 0)])
+        subgraph = graph.subgraph({2, 0})
+        self.assertEqual([m.full_name for m in subgraph.modules], ["m0", "m2"])
+        self.assertEqual(list(subgraph.edges()), [(0, 1), (1, 0)])
+        self.assertIsNone(subgraph.weights)
+
+    def test_weights_follow_kept_edges(self):
+        graph = _graph(3, [(0, 1), (1, 2), (0, 2), (2, 0)], [5, 6, 7, 8])
+        subgraph = graph.subgraph([0, 2])
+        self.assertEqual(_weights(subgraph), {(0, 1): 7, (1, 0): 8})
+
+
+class NeighbourhoodTest(unittest.TestCase):
+    def setUp(self):
+        # 0 -> 1 -> 2 -> 3, and 4 -> 1.
+        self.graph = _graph(5, [(0, 1), (1, 2), (2, 3), (4, 1)])
+
+    def find(self, roots, depth, direction):
+        return components._neighbourhood(self.graph, roots, depth, direction)
+
+    def test_out(self):
+        self.assertEqual(self.find([1], 1, "out"), {1, 2})
+        self.assertEqual(self.find([1], None, "out"), {1, 2, 3})
+
+    def test_in(self):
+        self.assertEqual(self.find([2], 1, "in"), {1, 2})
+        self.assertEqual(self.find([2], 2, "in"), {0, 1, 2, 4})
+
+    def test_both(self):
+        self.assertEqual(self.find([2], 1, "both"), {1, 2, 3})
+        self.assertEqual(self.find([2], 2, "both"), {0, 1, 2, 3, 4})
+
+    def test_depth_zero(self):
+        self.assertEqual(self.find([2], 0, "both"), {2})
+
+    def test_several_roots(self):
+        self.assertEqual(self.find([0, 3], 1, "out"), {0, 1, 3})
+
+    def test_depth_limit_on_random_graphs(self):
+        for graph in _random_graphs():
+            distances = {0: 0}
+            frontier = [0]
+            while frontier:
+                node = frontier.pop(0)
+                for successor in graph.successors(node):
+                    if successor not in distances:
+                        distances[successor] = distances[node] + 1
+                        frontier.append(successor)
+            for depth in (0, 1, 2, None):
+                self.assertEqual(
+                    components._neighbourhood(graph, [0], depth, "out"),
+                    {
+                        node
+                        for node, distance in distances.items()
+                        if depth is None or distance <= depth
+                    },
+                )
+
+
+class CollapseTest(unittest.TestCase):
+    NAMES = ["a.x.one", "a.x.two", "a.y.three", "b.four", "five"]
+    EDGES = [(0, 1), (0, 2), (1, 2), (2, 3), (2, 0), (3, 4)]
+
+    def test_packages_and_kept_modules(self):
+        graph = _graph(self.NAMES, self.EDGES)
+        collapsed = components._collapse(graph, 2)
+        self.assertEqual(
+            [m.full_name for m in collapsed.modules], ["a.x", "a.y", "b.four", "five"]
+        )
+        # Modules in fewer packages than the depth are kept as they are.
+        self.assertIs(collapsed.modules[2], graph.modules[3])
+        self.assertIs(collapsed.modules[3], graph.modules[4])
+        self.assertEqual(
+            _weights(collapsed), {(0, 1): 2, (1, 0): 1, (1, 2): 1, (2, 3): 1}
+        )
+
+    def test_self_loops_are_dropped(self):
+        collapsed = components._collapse(_graph(self.NAMES, self.EDGES), 1)
+        self.assertEqual([m.full_name for m in collapsed.modules], ["a", "b", "five"])
+        self.assertEqual(_weights(collapsed), {(0, 1): 1, (1, 2): 1})
+
+    def test_weighted_graph(self):
+        graph = _graph(self.NAMES, self.EDGES, [1, 2, 3, 4, 5, 6])
+        collapsed = components._collapse(graph, 2)
+        self.assertEqual(
+            _weights(collapsed), {(0, 1): 5, (1, 0): 5, (1, 2): 4, (2, 3): 6}
+        )
+        # Collapsing in steps sums the weights like collapsing at once.
+        self.assertEqual(
+            _weights(components._collapse(collapsed, 1)),
+            _weights(components._collapse(graph, 1)),
+        )
+
+    def test_merge_nodes(self):
+        graph = _graph(4, [(0, 1), (0, 2), (1, 3), (2, 3), (3, 0)])
+        modules = [components._Module(name, "") for name in ("p", "q")]
+        merged = components._merge_nodes(graph, array.array("i", [0, 1, 1, 0]), modules)
+        self.assertIs(merged.modules, modules)
+        self.assertEqual(_weights(merged), {(0, 1): 2, (1, 0): 2})
+
+
+class ShardByPackageTest(unittest.TestCase):
+    NAMES = ["a.one", "a.two", "b.three", "b.four", "five"]
+    # b.three -> five joins two stubs of package a.
+    EDGES = [(0, 1), (0, 2), (1, 0), (2, 3), (2, 4), (3, 4), (4, 0)]
+
+    def shard(self, weights=None, cycles=()):
+        graph = _graph(self.NAMES, self.EDGES, weights)
+        index, shards = components._shard_by_package(graph, cycles)
+        return index, {name: shard for name, *shard in shards}
+
+    def names(self, graph, nodes):
+        return {graph.modules[node].full_name for node in nodes}
+
+    def test_shards(self):
+        _, shards = self.shard()
+        self.assertEqual(list(shards), ["a", "b", components._TOP_LEVEL_SHARD])
+        graph, _, stubs = shards["a"]
+        self.assertEqual(
+            [m.full_name for m in graph.modules], ["a.one", "a.two", "b.three", "five"]
+        )
+        self.assertEqual(self.names(graph, stubs), {"b.three", "five"})
+        self.assertEqual(list(graph.edges()), [(0, 1), (0, 2), (1, 0), (3, 0)])
+
+    def test_edges_touch_the_shard(self):
+        _, shards = self.shard()
+        members = {
+            "a": {"a.one", "a.two"},
+            "b": {"b.three", "b.four"},
+            components._TOP_LEVEL_SHARD: {"five"},
+        }
+        for name, (graph, _, stubs) in shards.items():
+            with self.subTest(shard=name):
+                self.assertEqual(
+                    self.names(graph, set(range(len(graph))) - stubs), members[name]
+                )
+                for source, target in graph.edges():
+                    self.assertFalse(source in stubs and target in stubs)
+        # Each edge is in the shard of its source and, if different, of its target.
+        self.assertEqual(
+            sum(graph.edge_count for graph, _, _ in shards.values()),
+            len(self.EDGES) + 4,
+        )
+
+    def test_cycles(self):
+        _, shards = self.shard(cycles=[[0, 1], [0, 2, 4]])
+        self.assertEqual(shards["a"][1], [[0, 1], [0, 2, 3]])
+        self.assertEqual(shards["b"][1], [[0, 1, 3]])
+        self.assertEqual(shards[components._TOP_LEVEL_SHARD][1], [[0, 1, 3]])
+
+    def test_index_weights(self):
+        index, _ = self.shard()
+        self.assertEqual(
+            [m.full_name for m in index.modules],
+            ["a", "b", components._TOP_LEVEL_SHARD],
+        )
+        self.assertEqual(_weights(index), {(0, 1): 1, (1, 2): 2, (2, 0): 1})
+
+    def test_weighted_graph(self):
+        index, shards = self.shard(weights=[1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(_weights(index), {(0, 1): 2, (1, 2): 11, (2, 0): 7})
+        self.assertEqual(
+            _weights(shards["b"][0]), {(0, 1): 2, (1, 2): 4, (1, 3): 5, (2, 3): 6}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()